@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar archive of closed price history entries.
+
+Entries that were closed before a cutoff date never change again, so they are moved from price_history table to
+parquet files, partitioned by chain and month (of start date):
+    <archive folder>/chain_id=<chain id>/month=<YYYY-MM>/part-<timestamp>.parquet
+The UI history methods read both the table and the archive (see read_history and merge_history).
+
+requires pyarrow (optional, without it nothing is archived and the archive is not read).
+
+usage:
+    python archive.py --db postgresql+psycopg2://... --before 2016-01-01
+"""
+import os
+import time
+import logging
+import argparse
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import and_
+
+from sql_interface import SessionController, PriceHistory, StoreProduct, Store
+import sql_interface
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+    logger.warn("Couldn't import pyarrow, price history archive is disabled")
+
+archive_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_history_archive')
+archive_columns = ('id', 'store_product_id', 'start_date', 'end_date', 'price')
+
+
+def archive_schema():
+    return pyarrow.schema([('id', pyarrow.int64()),
+                           ('store_product_id', pyarrow.int64()),
+                           ('start_date', pyarrow.date32()),
+                           ('end_date', pyarrow.date32()),
+                           ('price', pyarrow.decimal128(10, 2))])
+
+
+class ArchivedPriceHistory(object):
+    """
+    Archived price history entry, with the same attributes as PriceHistory
+    (store_product is set by the reader, see UI.item2history_products)
+    """
+    __slots__ = archive_columns + ('store_product',)
+
+    def __init__(self, id, store_product_id, start_date, end_date, price, store_product=None):
+        self.id = id
+        self.store_product_id = store_product_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.price = price
+        self.store_product = store_product
+
+    def __repr__(self):
+        return '{}: {}<->{} = {} (archived)'.format(self.store_product_id, self.start_date, self.end_date, self.price)
+
+
+def write_partition(folder, chain_id, month, rows):
+    """
+    write rows to new parquet file in the partition folder of chain and month
+    Args:
+        folder: archive folder
+        chain_id:
+        month: 'YYYY-MM'
+        rows: list of tuples (in archive_columns order)
+    """
+    partition_folder = os.path.join(folder, 'chain_id={}'.format(chain_id), 'month={}'.format(month))
+    os.makedirs(partition_folder, exist_ok=True)
+    columns = list(zip(*rows))
+    columns[-1] = [Decimal(price).quantize(Decimal('0.01')) for price in columns[-1]]
+    table = pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type)
+                                       for column, field in zip(columns, archive_schema())], schema=archive_schema())
+    file_path = os.path.join(partition_folder, 'part-{}.parquet'.format(int(time.time() * 1000000)))
+    pyarrow.parquet.write_table(table, file_path, compression='zstd')
+
+
+def archive_closed_history(db, cutoff, folder=None, chunk_size=1000000, page_size=10000):
+    """
+    move price history entries that were closed before the cutoff date from the DB to the archive.
+    each chunk of entries (by id) is written to the archive and then deleted (by the ids that were written, so entries
+    that were closed meanwhile are left for the next run) and committed. if the commit fails the entries are in both
+    tiers, which is fine as the readers ignore duplicates (by id)
+
+    Args:
+        db: SessionController
+        cutoff: entries with end_date before this date are archived
+        folder: archive folder (default is archive_folder)
+        chunk_size: entries per chunk
+        page_size: entries ids per delete statement
+
+    Returns:
+        int: number of archived entries
+    """
+    if pyarrow is None:
+        logger.warn('pyarrow is not installed, nothing is archived')
+        return 0
+    folder = folder or archive_folder
+    closed = and_(PriceHistory.end_date != None, PriceHistory.end_date < cutoff)
+    archived = 0
+    last_id = 0
+    while True:
+        rows = db.query(PriceHistory.id, PriceHistory.store_product_id, PriceHistory.start_date,
+                        PriceHistory.end_date, PriceHistory.price, Store.chain_id) \
+            .join(StoreProduct, StoreProduct.id == PriceHistory.store_product_id) \
+            .join(Store, Store.id == StoreProduct.store_id) \
+            .filter(closed).filter(PriceHistory.id > last_id) \
+            .order_by(PriceHistory.id).limit(chunk_size).all()
+        if not rows:
+            break
+        partitions = {}  # (chain id, month): rows
+        for row in rows:
+            partitions.setdefault((row[-1], row[2].strftime('%Y-%m')), []).append(tuple(row[:-1]))
+        for (chain_id, month), partition_rows in partitions.items():
+            write_partition(folder, chain_id, month, partition_rows)
+
+        ids = [row[0] for row in rows]
+        last_id = ids[-1]
+        for i in range(0, len(ids), page_size):
+            db.query(PriceHistory).filter(PriceHistory.id.in_(ids[i:i + page_size])).delete(synchronize_session=False)
+        if not db.commit():
+            break
+        archived += len(rows)
+        logger.info('archived {} price history entries (up to id {})'.format(archived, last_id))
+    return archived
+
+
+def read_history(store_products_ids, chain_ids=None, folder=None):
+    """
+    read the archived entries of store products
+
+    Args:
+        store_products_ids: ids of the store products
+        chain_ids: chains of the store products (optional, only their partitions are read)
+        folder: archive folder (default is archive_folder)
+
+    Returns:
+        list(ArchivedPriceHistory)
+    """
+    folder = folder or archive_folder
+    if not os.path.isdir(folder) or not store_products_ids:
+        return []
+    if pyarrow is None:
+        logger.warn('pyarrow is not installed, archived price history is not read')
+        return []
+    dataset = pyarrow.dataset.dataset(folder, format='parquet', partitioning='hive')
+    condition = pyarrow.dataset.field('store_product_id').isin(list(store_products_ids))
+    if chain_ids is not None:
+        condition = condition & pyarrow.dataset.field('chain_id').isin(list(set(chain_ids)))
+    table = dataset.to_table(columns=list(archive_columns), filter=condition)
+    return [ArchivedPriceHistory(*row) for row in zip(*[table.column(name).to_pylist() for name in archive_columns])]
+
+
+def merge_history(entries, archived_entries, key=None):
+    """
+    merge price history entries from the DB and from the archive (duplicates, by id, are taken from the DB)
+
+    Args:
+        entries: PriceHistory list
+        archived_entries: ArchivedPriceHistory list
+        key: sort key of the merged list (default is start date)
+
+    Returns:
+        list
+    """
+    entries = list(entries)
+    ids = set(entry.id for entry in entries)
+    merged = entries + [entry for entry in archived_entries if entry.id not in ids]
+    merged.sort(key=key or (lambda entry: entry.start_date))
+    return merged
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--db', default=sql_interface.db, help='DB url')
+    arg_parser.add_argument('--before', required=True, help='archive entries closed before this date (YYYY-MM-DD)')
+    arg_parser.add_argument('--folder', default=archive_folder, help='archive folder')
+    args = arg_parser.parse_args()
+
+    cutoff = datetime.strptime(args.before, '%Y-%m-%d').date()
+    archived = archive_closed_history(SessionController(args.db), cutoff, args.folder)
+    logger.info('{} entries were archived to {}'.format(archived, args.folder))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Performance measurements of the data pipeline stages.
+run with paths of downloaded chain files, e.g.:
+    python benchmarks.py parse שופרסל/PriceFull7290027600007-001-201610170300.gz
+    python benchmarks.py bulk-load --db sqlite:///test.db
+    python benchmarks.py search --db sqlite:///test.db חלב "קוטג' 5%"
+    python benchmarks.py listing --rows 5000   # pages generated from the templates of fixtures/listing
+"""
+import os
+import re
+import time
+import argparse
+import logging
+from datetime import date
+
+from bs4 import BeautifulSoup
+from sqlalchemy import MetaData, Table, Column, Integer, BigInteger, Text, DECIMAL, Date
+import listing
+import search
+from sql_interface import SessionController, Item, StoreProduct
+from web_scraper import file_pattern
+from xml_parser import ChainXmlParser, prices_profile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def timed(func, *args):
+    """
+    run func and measure its run time
+    Returns:
+        (result, seconds)
+    """
+    start = time.time()
+    res = func(*args)
+    return res, time.time() - start
+
+
+def parse_prices_tree(file_path):
+    """
+    parse prices file the way it was done before the schema profiles: full tree, and find() per field
+    Returns:
+        int: number of parsed records
+    """
+    xml = ChainXmlParser.get_parsed_file(file_path)
+    item_elm_name = 'item'
+    if not [tag for tag in xml.iter(item_elm_name)]:
+        item_elm_name = 'product'
+    records = 0
+    for item_elm in xml.iter(item_elm_name):
+        ChainXmlParser.elm2int(item_elm, 'itemcode')
+        ChainXmlParser.elm2bool(item_elm, 'itemtype')
+        ChainXmlParser.elm2str(item_elm, 'itemname')
+        ChainXmlParser.elm2float(item_elm, 'quantity')
+        ChainXmlParser.elm2str(item_elm, 'unitqty')
+        ChainXmlParser.elm2float(item_elm, 'itemprice')
+        records += 1
+    return records
+
+
+def parse_prices_profile(file_path):
+    """
+    parse prices file with streaming and single pass extraction
+    Returns:
+        int: number of parsed records
+    """
+    extract = prices_profile.extractor()
+    records = 0
+    for item_elm in ChainXmlParser.iter_profile_records(file_path, prices_profile):
+        extract(item_elm)
+        records += 1
+    return records
+
+
+def parse_benchmark(file_paths):
+    """
+    report prices parsing throughput (records/sec), before and after the schema profiles
+    """
+    for file_path in file_paths:
+        for name, func in (('tree', parse_prices_tree), ('profile', parse_prices_profile)):
+            records, seconds = timed(func, file_path)
+            logger.info('{} [{}]: {} records, {:.0f} records/sec'.format(file_path, name, records, records / seconds))
+
+
+def bulk_load_benchmark(db_path, rows_num):
+    """
+    report rows/sec of the bulk insert methods of the DB (see SessionController.bulk_load).
+    rows are inserted to a scratch table, which is dropped at the end (sqlite DDL is not rolled back)
+    """
+    db = SessionController(db_path)
+    table = Table('bulk_load_benchmark', MetaData(),
+                  Column('id', Integer, primary_key=True),
+                  Column('code', BigInteger),
+                  Column('name', Text),
+                  Column('price', DECIMAL(precision=10, scale=2)),
+                  Column('start_date', Date))
+    columns = ('code', 'name', 'price', 'start_date')
+    rows = [(7290000000000 + i, 'מוצר {}'.format(i), i % 1000 / 10.0, date.today()) for i in range(rows_num)]
+
+    methods = [('executemany', db.insert_rows)]
+    if db.engine.dialect.name == 'postgresql':
+        methods.append(('copy', db.copy_rows))
+    try:
+        table.create(db.session.connection())
+        for name, method in methods:
+            res, seconds = timed(method, table, columns, rows)
+            logger.info('{} [{}]: {} rows, {:.0f} rows/sec'.format(db.engine.dialect.name, name, rows_num,
+                                                                   rows_num / seconds))
+    finally:
+        db.session.rollback()
+        table.drop(db.engine, checkfirst=True)
+
+
+def search_benchmark(db_path, names, repeat):
+    """
+    report names search time (see search.name_condition), and check that on sqlite the FTS5 search tables are
+    searched with their trigram index and not scanned
+    """
+    db = SessionController(db_path)
+    indexed = db.engine.dialect.name == 'sqlite' and search.is_indexed(db)
+    for model in (Item, StoreProduct):
+        for name in names:
+            query = db.query(model.id).filter(search.name_condition(db, model, name))
+            if indexed and len(search.normalize_name(name)) >= search.min_query_length:
+                plan = search.fts_plan(db, query)
+                assert plan and all('INDEX 0:L' in detail for detail in plan), \
+                    'search of {!r} scans the FTS table: {}'.format(name, plan)
+            start = time.time()
+            for _ in range(repeat):
+                results = len(query.all())
+            logger.info('{} [{}]: {} results, {:.1f} ms/search'.format(model.__tablename__, name, results,
+                                                                      (time.time() - start) * 1000 / repeat))
+
+
+# listing page templates of each site format (shufersal files table, matrixcatalog table, folder listing, bitan):
+# the pages markup with a few file rows between the files markers, see expand_listing_page
+listing_fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'listing')
+files_markers = ('<!-- files -->', '<!-- /files -->')
+store_file_re = re.compile(r'-(\d{3})-(?=\d{12})')
+# listing page file name prefix: links extraction of the site
+listing_extractors = {
+    'shufersal': listing.shufersal_files,
+    'matrix': listing.matrix_files,
+    'nibit': listing.matrix_files,
+    'mega': listing.folder_files,
+    'zol': listing.folder_files,
+    'bitan': listing.links,
+}
+
+
+def extract_links_bs(text):
+    """
+    extract the file links of a listing page the way it was done before the listing module:
+    BeautifulSoup html.parser tree, and find_all('a') on it
+    Returns:
+        int: number of file links
+    """
+    page = BeautifulSoup(text, 'html.parser')
+    return len([a for a in page.find_all('a', href=True)
+                if file_pattern.match(a.text) or file_pattern.match(a['href'])])
+
+
+def extract_links_lxml(text, extractor):
+    """
+    extract the file links of a listing page with lxml and the compiled selectors of the site
+    Returns:
+        int: number of file links
+    """
+    links = extractor(listing.parse_page(text))
+    return len([link for link in links if file_pattern.match(link[0]) or file_pattern.match(link[1])])
+
+
+def expand_listing_page(text, rows):
+    """
+    make listing page of realistic size (the big tables of Shufersal and matrixcatalog have thousands of rows) from
+    page template: the file rows between the files markers are repeated, with other store ids in each copy
+    Args:
+        text: page template html
+        rows: number of file rows in the page
+
+    Returns:
+        str: page html (the page as it is if it has no files markers)
+    """
+    if files_markers[0] not in text:
+        return text
+    head, rest = text.split(files_markers[0], 1)
+    block, tail = rest.split(files_markers[1], 1)
+    lines = [line for line in block.splitlines() if line.strip()]
+    page_rows = []
+    for i in range(rows):
+        copy = i // len(lines)
+        page_rows.append(store_file_re.sub(lambda m: '-{:03}-'.format((int(m.group(1)) + 10 * copy) % 1000),
+                                           lines[i % len(lines)]))
+    return head + '\n'.join(page_rows) + tail
+
+
+def listing_benchmark(fixtures_folder, repeat, rows):
+    """
+    report listing pages parsing throughput (pages/sec), BeautifulSoup vs lxml, on pages generated from the listing
+    templates (or on saved listing pages)
+    """
+    for file_name in sorted(os.listdir(fixtures_folder)):
+        site = next((site for site in listing_extractors if file_name.lower().startswith(site)), None)
+        extractor = listing_extractors.get(site, listing.links)
+        with open(os.path.join(fixtures_folder, file_name), 'rb') as f:
+            text = f.read().decode('utf8', 'replace')
+        if rows:
+            text = expand_listing_page(text, rows)
+        for name, func, args in (('bs4', extract_links_bs, ()), ('lxml', extract_links_lxml, (extractor,))):
+            start = time.time()
+            for _ in range(repeat):
+                links = func(text, *args)
+            seconds = time.time() - start
+            logger.info('{} [{}, {}]: {} file links, {:.1f} pages/sec'.format(file_name, site or 'links', name, links,
+                                                                             repeat / seconds))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    sub_parsers = arg_parser.add_subparsers(dest='benchmark')
+    parse_parser = sub_parsers.add_parser('parse', help='prices files parsing throughput')
+    parse_parser.add_argument('files', nargs='+', help='prices files paths')
+    bulk_load_parser = sub_parsers.add_parser('bulk-load', help='DB bulk load rows/sec')
+    bulk_load_parser.add_argument('--db', required=True, help='DB url (scratch DB, not the production one)')
+    bulk_load_parser.add_argument('--rows', default=100000, type=int, help='number of rows to insert')
+    search_parser = sub_parsers.add_parser('search', help='names search time, and check of the search indexes use')
+    search_parser.add_argument('--db', required=True, help='DB url')
+    search_parser.add_argument('--repeat', default=10, type=int, help='times to run each search')
+    search_parser.add_argument('names', nargs='+', help='searched names')
+    listing_parser = sub_parsers.add_parser('listing', help='listing pages links extraction pages/sec')
+    listing_parser.add_argument('fixtures', nargs='?', default=listing_fixtures,
+                                help='folder of listing page templates or saved pages (named by site, e.g. '
+                                     'shufersal1.html)')
+    listing_parser.add_argument('--rows', default=5000, type=int,
+                                help='file rows of the pages generated from the templates (0 for the templates as '
+                                     'they are)')
+    listing_parser.add_argument('--repeat', default=10, type=int, help='times to parse each page')
+
+    args = arg_parser.parse_args()
+    if args.benchmark == 'parse':
+        parse_benchmark(args.files)
+    elif args.benchmark == 'bulk-load':
+        bulk_load_benchmark(args.db, args.rows)
+    elif args.benchmark == 'search':
+        search_benchmark(args.db, args.names, args.repeat)
+    elif args.benchmark == 'listing':
+        listing_benchmark(args.fixtures, args.repeat, args.rows)
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
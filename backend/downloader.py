@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent files download of the chain scrapers.
+
+All the scrapers of a process share one Downloader: a threads pool that downloads the files of a listing concurrently,
+with a cap on the concurrent downloads from each host (the chains sites don't like many connections), retries with
+exponential backoff for network errors and temporary server errors, and a bandwidth budget (bytes/sec) shared by all
+the downloads of the process.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+max_workers = 16
+max_host_connections = 4
+max_retries = 3
+retry_backoff = 1.0  # seconds, doubled on each retry
+retry_statuses = (429, 500, 502, 503, 504)
+bandwidth_limit = None  # bytes/sec of all the downloads of the process, None for no limit
+chunk_size = 1024 * 1000
+part_suffix = '.part'  # suffix of files that are still downloaded
+
+
+class TokenBucket(object):
+    """
+    bandwidth budget: consuming more bytes than the rate allows blocks the consuming thread until they are available
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or self.rate  # allowed burst
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Downloader(object):
+    """
+    threads pool of downloads, with per host concurrency cap, retries and bandwidth budget
+    """
+    def __init__(self, workers=None, host_connections=None, bandwidth=None, retries=None, backoff=None):
+        self.workers = workers or max_workers
+        self.host_connections = host_connections or max_host_connections
+        self.retries = max_retries if retries is None else retries
+        self.backoff = retry_backoff if backoff is None else backoff
+        bandwidth = bandwidth or bandwidth_limit
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.hosts = {}  # host: semaphore
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            try:
+                return self.hosts[host]
+            except KeyError:
+                semaphore = self.hosts[host] = threading.BoundedSemaphore(self.host_connections)
+                return semaphore
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    def fetch(self, session, url, file_path):
+        """
+        single download attempt. the file is written to temporary path and renamed when completed, so a failed
+        download doesn't leave a partial file (which would be taken as downloaded)
+
+        Returns:
+            bool: True if the file was downloaded, False if the server refused (not worth retrying)
+        Raises:
+            requests.exceptions.RequestException: network errors and temporary server errors
+        """
+        part_path = file_path + part_suffix
+        with self.host_semaphore(url):
+            res = session.get(url, stream=True, verify=False)
+            try:
+                if res.status_code in retry_statuses:
+                    res.raise_for_status()
+                if not res.ok:
+                    logger.warn('download of {} failed: {} {}'.format(url, res.status_code, res.reason))
+                    return False
+                size = 0
+                with open(part_path, 'wb') as f:
+                    for block in res.iter_content(chunk_size):
+                        if self.bucket is not None:
+                            self.bucket.consume(len(block))
+                        f.write(block)
+                        size += len(block)
+            finally:
+                res.close()
+        os.replace(part_path, file_path)
+        self.count(downloaded_files=1, downloaded_bytes=size)
+        return True
+
+    def download(self, session, url, file_path):
+        """
+        download url into file path (in the calling thread), with retries
+
+        Args:
+            session: requests.Session to download with
+            url:
+            file_path:
+
+        Returns:
+            str: file path, None if the download failed
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                if self.fetch(session, url, file_path):
+                    return file_path
+                break
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries:
+                    logger.warn('download of {} failed after {} attempts: {}'.format(url, attempt + 1, e))
+                    break
+                delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+                logger.info('download of {} failed ({}), retrying in {:.1f} seconds'.format(url, e, delay))
+                self.count(download_retries=1)
+                time.sleep(delay)
+        if os.path.exists(file_path + part_suffix):
+            os.remove(file_path + part_suffix)
+        self.count(failed_downloads=1)
+
+    def download_all(self, session, downloads):
+        """
+        download all (url, file path) pairs concurrently
+
+        Returns:
+            list(str): file path of each pair (in the same order), None for failed downloads
+        """
+        futures = [self.executor.submit(self.download, session, url, file_path) for url, file_path in downloads]
+        return [future.result() for future in futures]
+
+    def pop_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, Counter()
+        return stats
+
+
+process_downloader = None
+
+
+def configure(workers=None, host_connections=None, bandwidth=None):
+    """
+    set the download settings of the process (used as processes pool initializer, before any download)
+    """
+    global max_workers, max_host_connections, bandwidth_limit, process_downloader
+    max_workers = workers or max_workers
+    max_host_connections = host_connections or max_host_connections
+    bandwidth_limit = bandwidth or bandwidth_limit
+    process_downloader = None
+
+
+def get_downloader():
+    """
+    get the (per process) downloader
+    Returns:
+        Downloader
+    """
+    global process_downloader
+    if process_downloader is None:
+        process_downloader = Downloader()
+    return process_downloader
+
+
+def pop_download_stats():
+    """
+    get the download stats of this process (since last call)
+    Returns:
+        Counter
+    """
+    if process_downloader is None:
+        return Counter()
+    return process_downloader.pop_stats()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy import func
+
+from sql_interface import Item
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ItemCodeRegistry(object):
+    """
+    Process level code -> id index of the items table.
+
+    The table is loaded once into two sorted int64 arrays (codes and ids), so it takes 16 bytes per item.
+    Items that are inserted later are kept in a small dict, and merged into the arrays when it grows.
+    """
+    def __init__(self, merge_size=100000):
+        self.codes = array('q')
+        self.ids = array('q')
+        self.new_items = {}  # code: id
+        self.merge_size = merge_size
+        self.loaded = False
+
+    def load(self, db, page_size=100000):
+        """
+        load all items from the DB
+        Args:
+            db: SessionController
+            page_size:
+        """
+        self.reset()
+        last_code = None
+        for code, item_id in db.query(Item.code, Item.id).order_by(Item.code, Item.id).yield_per(page_size):
+            if code == last_code:  # same code for more than one item, first one is used
+                continue
+            self.codes.append(code)
+            self.ids.append(item_id)
+            last_code = code
+        self.loaded = True
+        logger.info('loaded {} items codes'.format(len(self.codes)))
+
+    def reset(self):
+        """
+        clear the registry (e.g. after rollback, when it may hold ids that are not in the DB)
+        """
+        self.codes = array('q')
+        self.ids = array('q')
+        self.new_items.clear()
+        self.loaded = False
+
+    def get(self, code, default=None):
+        """
+        Args:
+            code: item code
+            default: returned if there is no item with this code
+
+        Returns:
+            int: item id
+        """
+        try:
+            return self.new_items[code]
+        except KeyError:
+            pass
+        i = bisect_left(self.codes, code)
+        if i < len(self.codes) and self.codes[i] == code:
+            return self.ids[i]
+        return default
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def __len__(self):
+        return len(self.codes) + len(self.new_items)
+
+    def add(self, code, item_id):
+        """
+        add new item to the registry
+        """
+        if code in self:
+            return
+        self.new_items[code] = item_id
+        if len(self.new_items) >= self.merge_size:
+            self.merge()
+
+    def add_from_db(self, db, codes, page_size=10000):
+        """
+        add the items with given codes (that were just inserted) from the DB.
+        the items need to be flushed first, for having ids. same code for more than one item - the first one (lowest
+        id) is used, as in load
+
+        Args:
+            db: SessionController
+            codes: list of items codes
+            page_size:
+        """
+        for i in range(0, len(codes), page_size):
+            for code, item_id in db.query(Item.code, func.min(Item.id)) \
+                    .filter(Item.code.in_(codes[i:i + page_size])).group_by(Item.code):
+                self.add(code, item_id)
+
+    def merge(self):
+        """
+        merge the new items into the sorted arrays
+        """
+        items = sorted(list(zip(self.codes, self.ids)) + list(self.new_items.items()))
+        self.codes = array('q', (code for code, item_id in items))
+        self.ids = array('q', (item_id for code, item_id in items))
+        self.new_items.clear()
+
+
+registries = {}
+
+
+def get_item_registry(db):
+    """
+    get the (per process) items registry of the DB. it is loaded on first call
+    Args:
+        db: SessionController
+
+    Returns:
+        ItemCodeRegistry
+    """
+    key = str(db.engine.url)
+    try:
+        registry = registries[key]
+    except KeyError:
+        registry = registries[key] = ItemCodeRegistry()
+    if not registry.loaded:
+        registry.load(db)
+    return registry
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Files links extraction from the chains listing pages.
+
+The listing pages are parsed with lxml.html, and the file links of each site are selected in bulk with compiled
+XPath selectors (instead of BeautifulSoup html.parser tree and find_all('a') on it, which is slow on the big
+tables of Shufersal and matrixcatalog).
+"""
+import lxml.html
+from lxml import etree
+
+# all sites: every link of the page
+links_xpath = etree.XPath('//a[@href]')
+# shufersal: files table (size in column [2]), and link to the next page of the table
+shufersal_size_xpath = etree.XPath('normalize-space(ancestor::tr[1]/td[3])')
+shufersal_next_page_xpath = etree.XPath('//a[@href][. = ">"]/@href')
+# matrixcatalog: files table of all the chains, chain name in column [1] and file link in column [7]
+matrix_rows = '(//table)[1]//tr[td[8]//a[@href]]'
+matrix_chains_xpath = etree.XPath(matrix_rows + '/td[2]')
+matrix_hrefs_xpath = etree.XPath(matrix_rows + '/td[8]/descendant::a[@href][1]/@href')
+
+
+def parse_page(text):
+    """
+    parse html page
+    Args:
+        text: page html
+
+    Returns:
+        lxml.html.HtmlElement: document root
+    """
+    try:
+        return lxml.html.document_fromstring(text)
+    except ValueError:
+        # unicode strings with encoding declaration are not supported by lxml
+        return lxml.html.document_fromstring(text.encode('utf8'))
+
+
+def links(doc):
+    """
+    Returns:
+        list: (text, href) of all the links of the page
+    """
+    return [(a.text_content(), a.get('href')) for a in links_xpath(doc)]
+
+
+def folder_files(doc):
+    """
+    links of apache style folder listing (mega, zol vebegadol)
+    Returns:
+        list: (text, href, size) of all the links of the page. size is the last word after the link (None if there is
+        none)
+    """
+    res = []
+    for a in links_xpath(doc):
+        tail = (a.tail or '').split()
+        res.append((a.text_content(), a.get('href'), tail[-1] if tail else None))
+    return res
+
+
+def shufersal_files(doc):
+    """
+    links of shufersal files table page
+    Returns:
+        list: (text, href, size) of all the links of the page, size is None for links outside of the table
+    """
+    return [(a.text_content(), a.get('href'), shufersal_size_xpath(a) or None) for a in links_xpath(doc)]
+
+
+def shufersal_next_page(doc):
+    """
+    Returns:
+        str: href of the next page of shufersal files table, None on the last page
+    """
+    hrefs = shufersal_next_page_xpath(doc)
+    return hrefs[0] if hrefs else None
+
+
+def matrix_files(doc):
+    """
+    links of matrixcatalog files table
+    Returns:
+        list: (chain name, href) of each file in the table
+    """
+    return list(zip((td.text_content() for td in matrix_chains_xpath(doc)), matrix_hrefs_xpath(doc)))
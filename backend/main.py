@@ -1,12 +1,27 @@
 # -*- coding: utf-8 -*-
 from multiprocessing import Process, Pool
 from itertools import repeat
+from collections import Counter
 import argparse
 import web_scraper
-from sql_interface import SessionController, Chain, Store, dbs
+import downloader
+import sql_interface
+from sql_interface import SessionController, Chain, Store, FileType, dbs, init_process_engine, pop_engine_stats
 from xml_parser import ChainXmlParser
+from item_registry import get_item_registry
 
 import time
+from datetime import date, timedelta
+
+
+def init_process(db_path, db_pool_size, pre_ping, download_workers, host_connections, download_bandwidth,
+                 http_pool_size, http_timeout):
+    """
+    processes pool initializer: DB engine, downloader and HTTP settings of the process
+    """
+    init_process_engine(db_path, db_pool_size, pre_ping)
+    downloader.configure(download_workers, host_connections, download_bandwidth)
+    web_scraper.configure_http(http_pool_size, http_timeout)
 
 
 def download_chain_data(chain):
@@ -17,24 +32,91 @@ def download_chain_data(chain):
     except BaseException as e:
         print('{} data download failed'.format(chain.name))
         print(e)
+    return downloader.pop_download_stats() + web_scraper.pop_http_stats()
 
 
 def parse_chain_stores(chain):
+    parser = ChainXmlParser(chain)
     try:
-        parser = ChainXmlParser(chain)
         parser.parse_stores()
         print('parsed stores for')
+        return parser.stats + pop_engine_stats()
     except BaseException as e:
         print(e)
+    finally:
+        parser.close()  # the connection is returned to the process pool
+    return pop_engine_stats()
 
 
 def parse_chain_prices(chain, store):
+    parser = ChainXmlParser(chain)
     try:
-        parser = ChainXmlParser(chain)
         parser.parse_store_prices(store)
         print('parsed prices for', parser.chain.name, store)
+        return parser.stats + pop_engine_stats()
+    except BaseException as e:
+        print(e)
+    finally:
+        parser.close()  # the connection is returned to the process pool
+    return pop_engine_stats()
+
+
+def read_store_prices(args):
+    """
+    parse stage of the pipeline mode: only parse the store prices file, no DB access
+    Args:
+        args: (chain, store, last digest)
+
+    Returns:
+        (store, (digest, ProductsBatch)): None instead of the parsed file if the parsing failed
+    """
+    chain, store, last_digest = args
+    try:
+        return store, ChainXmlParser(chain).read_store_prices(store, last_digest=last_digest)
     except BaseException as e:
         print(e)
+    return store, None
+
+
+def ingest_chains_prices(pool, db, chains):
+    """
+    pipeline mode: the pool processes only parse the prices files into batches,
+    and all batches are written to the DB here, with a single commit per chain
+    Args:
+        pool: processes pool
+        db: DB to write the parsed prices to
+        chains: chains to parse
+
+    Returns:
+        Counter: parse stats
+    """
+    stats = Counter()
+    for chain in chains:
+        s = time.time()
+        print('parsing prices for chain {}'.format(chain.name))
+        writer = ChainXmlParser(chain, db)
+        last_digests = writer.get_stores_last_digests(FileType.prices)
+        stores = [store for store in db.query(Store).filter(Store.chain_id == chain.id)]
+        tasks = [(chain, store, last_digests.get(store.id)) for store in stores]
+        for store, parsed in pool.imap_unordered(read_store_prices, tasks):
+            if parsed is None:
+                continue
+            # each store is written in a savepoint, so a failing store doesn't roll back the other stores of the chain
+            savepoint = db.session.begin_nested()
+            store_stats = Counter(writer.stats)
+            try:
+                writer.ingest_store_prices(store, date.today(), *parsed)
+                savepoint.commit()
+            except Exception as e:
+                print('writing prices of store {} failed, skipping it'.format(store))
+                print(e)
+                db.rollback_savepoint(savepoint)
+                writer.stats = store_stats
+                get_item_registry(db).reset()  # may hold ids of rolled back items
+        writer.commit()
+        stats += writer.stats
+        print('chain parsing ended: {}'.format(time.time() - s))
+    return stats
 
 
 def main():
@@ -44,12 +126,39 @@ def main():
                             action='store_true')
     arg_parser.add_argument('--parse-chains', '-c', help="parse chains login data from the government webpage",
                             default=False, action='store_true')
+    arg_parser.add_argument('--pipeline', help="parse prices files in the processes, and write all of them to the DB "
+                                               "from the main process", default=False, action='store_true')
+    arg_parser.add_argument('--partition-history', help='create new price history table as monthly partitioned table '
+                                                        '(postgres only)', default=False, action='store_true')
+    arg_parser.add_argument('--db-pool-size', help='DB connections pool size of each process', default=1, type=int)
+    arg_parser.add_argument('--no-pre-ping', help="don't test DB connections before using them", default=False,
+                            action='store_true')
+    arg_parser.add_argument('--download-workers', help='concurrent downloads of each process', default=16, type=int)
+    arg_parser.add_argument('--host-connections', help='max concurrent downloads from the same host (per process)',
+                            default=4, type=int)
+    arg_parser.add_argument('--download-bandwidth', help='downloads bandwidth budget in KB/sec (of all processes)',
+                            default=None, type=int)
+    arg_parser.add_argument('--http-pool-size', help='kept alive connections per host of each scraper session '
+                                                     '(default is --host-connections)', default=None, type=int)
+    arg_parser.add_argument('--http-timeout', help='read timeout (seconds) of scraper requests', default=120,
+                            type=float)
 
     args = arg_parser.parse_args()
 
     start = time.time()
-    p = Pool(processes=args.processes)
+    # each process creates its DB engine once, the schema is checked only here (by the main process DB)
+    # set before the processes are forked, so they have it too
+    sql_interface.history_partitions = args.partition_history
+    # the downloads bandwidth budget is split between the processes
+    download_bandwidth = args.download_bandwidth and args.download_bandwidth * 1024 // args.processes
+    p = Pool(processes=args.processes, initializer=init_process,
+             initargs=(sql_interface.db, args.db_pool_size, not args.no_pre_ping, args.download_workers,
+                       args.host_connections, download_bandwidth, args.http_pool_size,
+                       (web_scraper.http_timeout[0], args.http_timeout)))
     db = SessionController()
+    # price history partitions are created here, so the processes won't need to create them
+    db.ensure_history_partitions(date.today(), date.today() + timedelta(days=31))
+    db.commit()
 
     # 1) get all chains (and subchains)
     if args.parse_chains:
@@ -62,24 +171,36 @@ def main():
     if not args.no_download:
         s = time.time()
         print('Downloading all chains data')
-        res = p.map(download_chain_data, chains)
+        download_stats = sum(p.map(download_chain_data, chains), Counter())
         print('data download: {}'.format(time.time() - s))
+        print('downloaded files: {} ({:.1f} MB), retries: {}, failed downloads: {}'.format(
+            download_stats['downloaded_files'], download_stats['downloaded_bytes'] / 2 ** 20,
+            download_stats['download_retries'], download_stats['failed_downloads']))
+        print('HTTP requests: {}, connections: {}, connection reuse: {:.0%}'.format(
+            download_stats['http_requests'], download_stats['http_connections'],
+            1 - download_stats['http_connections'] / max(download_stats['http_requests'], 1)))
 
     # 3) parse all chain stores
     s = time.time()
     print('parsing all chains stores')
-    res = p.map(parse_chain_stores, chains)
+    stats = sum(p.map(parse_chain_stores, chains), Counter())
     print('stores parsing: {}'.format(time.time() - s))
 
     # 4) parse stores daily prices and promos
-    for chain in chains:
-        s = time.time()
-        print('parsing prices for chain {}'.format(chain.name))
-        stores = [store for store in db.query(Store).filter(Store.chain_id == chain.id)]
-        p.starmap(parse_chain_prices, zip(repeat(chain), stores))
-        print('chain parsing ended: {}'.format(time.time() - s))
-
-    # ChainXmlParser.set_products_item_id(db)
+    if args.pipeline:
+        stats += ingest_chains_prices(p, db, chains)
+    else:
+        for chain in chains:
+            s = time.time()
+            print('parsing prices for chain {}'.format(chain.name))
+            stores = [store for store in db.query(Store).filter(Store.chain_id == chain.id)]
+            stats += sum(p.starmap(parse_chain_prices, zip(repeat(chain), stores)), Counter())
+            print('chain parsing ended: {}'.format(time.time() - s))
+
+    stats += pop_engine_stats()
+    print('parsed files: {}, skipped unchanged files: {}'.format(stats['parsed_files'], stats['skipped_files']))
+    print('DB connections: {}, DB setup time: {:.2f} seconds (all processes)'.format(stats['db_connections'],
+                                                                                 stats['db_setup_time']))
     print('total time: {}'.format(time.time() - start))
 
 if __name__ == '__main__':
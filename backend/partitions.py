@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Monthly range partitions of the price history table (postgres only).
+
+In partitioned mode price_history is partitioned by start_date, with a partition for each month
+(price_history_YYYY_MM). The partitions are created ahead by the main process (see
+SessionController.ensure_history_partitions), and the open entries (end_date IS NULL) are found with the partial
+index of PriceHistory, so the lookups don't depend on the number of closed entries.
+
+usage:
+    python partitions.py --db postgresql+psycopg2://... migrate     # convert existing price_history table
+    python partitions.py --db postgresql+psycopg2://... ensure 2016-01-01 2016-12-31
+"""
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+history_table = 'price_history'
+
+# same columns as PriceHistory. the primary key of partitioned table must include the partition key
+partitioned_history_ddl = """
+CREATE TABLE {table} (
+    id BIGSERIAL NOT NULL,
+    store_product_id BIGINT REFERENCES store_products (id),
+    start_date DATE NOT NULL,
+    end_date DATE,
+    price NUMERIC(10, 2),
+    PRIMARY KEY (id, start_date),
+    UNIQUE (start_date, store_product_id)
+) PARTITION BY RANGE (start_date)
+"""
+
+
+def month_start(d):
+    return d.replace(day=1)
+
+
+def next_month(d):
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def partition_name(month):
+    return '{}_{:%Y_%m}'.format(history_table, month)
+
+
+def is_partitioned(connection):
+    """
+    Returns:
+        bool: True if the price history table is partitioned
+    """
+    return connection.execute(text(
+        'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid '
+        'WHERE c.relname = :table AND pg_table_is_visible(c.oid))'), {'table': history_table}).scalar()
+
+
+def get_partitions(connection):
+    """
+    Returns:
+        set: names of the partitions of the price history table
+    """
+    rows = connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table AND pg_table_is_visible(p.oid)'),
+        {'table': history_table})
+    return set(name for name, in rows)
+
+
+def create_partitioned_history(connection):
+    """
+    create the (empty) partitioned price history table
+    """
+    logger.info('creating partitioned {} table'.format(history_table))
+    connection.execute(text(partitioned_history_ddl.format(table=history_table)))
+
+
+def create_partition(connection, month):
+    """
+    create the partition of the month.
+    it is created as a separate table and then attached, which locks the history table less than
+    CREATE TABLE ... PARTITION OF (other processes can keep writing to the other partitions)
+    """
+    name = partition_name(month)
+    logger.info('creating {} partition {}'.format(history_table, name))
+    connection.execute(text('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(name, history_table)))
+    connection.execute(text("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}')".format(
+        history_table, name, month, next_month(month))))
+
+
+def ensure_history_partitions(connection, start_date, end_date, partitions=None):
+    """
+    create the missing partitions of the months of the dates range
+
+    Args:
+        connection: DB connection
+        start_date:
+        end_date:
+        partitions: names of the existing partitions (loaded from the DB if None), created partitions are added to it
+
+    Returns:
+        set: names of the partitions
+    """
+    if partitions is None:
+        partitions = get_partitions(connection)
+    month = month_start(start_date)
+    while month <= end_date:
+        name = partition_name(month)
+        if name not in partitions:
+            create_partition(connection, month)
+            partitions.add(name)
+        month = next_month(month)
+    return partitions
+
+
+def migrate_history(connection):
+    """
+    convert existing (not partitioned) price history table to partitioned table, with all of its entries.
+    the indexes of the new table are created by SessionController.create_schema
+    """
+    old_table = history_table + '_unpartitioned'
+    connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(history_table, old_table)))
+    create_partitioned_history(connection)
+    first_date, last_date = connection.execute(
+        text('SELECT MIN(start_date), MAX(start_date) FROM {}'.format(old_table))).first()
+    if first_date is not None:
+        ensure_history_partitions(connection, first_date, last_date)
+    moved = connection.execute(text(
+        'INSERT INTO {} (id, store_product_id, start_date, end_date, price) '
+        'SELECT id, store_product_id, start_date, end_date, price FROM {}'.format(history_table, old_table)))
+    logger.info('moved {} entries to partitioned {} table'.format(moved.rowcount, history_table))
+    connection.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE((SELECT MAX(id) FROM {0}), 0) + 1, false)"
+        .format(history_table)))
+    connection.execute(text('DROP TABLE {}'.format(old_table)))
+
+
+def main():
+    import sql_interface
+    from sql_interface import SessionController
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--db', default=sql_interface.db, help='DB url (postgres)')
+    sub_parsers = arg_parser.add_subparsers(dest='command')
+    sub_parsers.add_parser('migrate', help='convert the price history table to partitioned table')
+    ensure_parser = sub_parsers.add_parser('ensure', help='create the partitions of a dates range')
+    ensure_parser.add_argument('start_date', help='YYYY-MM-DD')
+    ensure_parser.add_argument('end_date', help='YYYY-MM-DD')
+    args = arg_parser.parse_args()
+
+    db = SessionController(args.db)
+    connection = db.session.connection()
+    if args.command == 'migrate':
+        if is_partitioned(connection):
+            logger.info('{} is already partitioned'.format(history_table))
+            return
+        migrate_history(connection)
+        if db.commit():
+            db.create_schema()
+    elif args.command == 'ensure':
+        if not is_partitioned(connection):
+            logger.info('{} is not partitioned (run migrate first)'.format(history_table))
+            return
+        ensure_history_partitions(connection, datetime.strptime(args.start_date, '%Y-%m-%d').date(),
+                                  datetime.strptime(args.end_date, '%Y-%m-%d').date())
+        db.commit()
+    else:
+        arg_parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+from sql_interface import Unit
+from search import normalize_name
+
+
+class ProductsBatch(object):
+    """
+    Compact columnar representation of the products parsed from a single prices file.
+
+    Each product is a row in parallel columns (code, external, name, quantity, unit, price), products are unique by
+    code. Rows that are inserted to the DB are loaded as plain tuples (see SessionController.bulk_load).
+    """
+    __slots__ = ('codes', 'external', 'names', 'quantities', 'units', 'prices', 'rows')
+
+    def __init__(self):
+        self.codes = array('q')
+        self.external = array('b')
+        self.names = []
+        self.quantities = array('d')
+        self.units = []
+        self.prices = array('d')
+        self.rows = {}  # code: row index
+
+    def add(self, code, external, name, quantity, unit, price):
+        """
+        add product to the batch.
+        if the code is already in the batch, only its price is updated
+        """
+        row = self.rows.get(code)
+        if row is not None:
+            self.prices[row] = price
+            return
+        self.rows[code] = len(self.codes)
+        self.codes.append(code)
+        self.external.append(external)
+        self.names.append(name)
+        self.quantities.append(quantity)
+        self.units.append(unit)
+        self.prices.append(price)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def price(self, code):
+        return self.prices[self.rows[code]]
+
+    def external_rows(self):
+        """
+        Returns:
+            list(int): rows of the global (external) products
+        """
+        return [row for row, external in enumerate(self.external) if external]
+
+    # columns of the rows generated by store_product_row and item_row
+    store_product_columns = ('code', 'store_id', 'external', 'name', 'quantity', 'unit', 'search_name')
+    item_columns = ('code', 'quantity', 'unit', 'name', 'search_name')
+
+    def store_product_row(self, row, store_id):
+        """
+        Returns:
+            tuple: StoreProduct values of the row (see store_product_columns)
+        """
+        name = self.names[row]
+        return (self.codes[row], store_id, bool(self.external[row]), name, self.quantities[row], self.units[row],
+                normalize_name(name))
+
+    def item_row(self, row):
+        """
+        Returns:
+            tuple: Item values of the row (see item_columns)
+        """
+        name = self.names[row]
+        return self.codes[row], self.quantities[row], Unit.to_unit(self.units[row]), name, normalize_name(name)
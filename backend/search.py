@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Names search of items and store products.
+
+Names are searched by their normalized form (search_name column, see normalize_name), so different spellings of the
+same name match: with/without niqqud, geresh/gershayim or quotes (ק"ג, ק״ג, קג), final letters, punctuation.
+
+postgres - pg_trgm GIN index on search_name: substring (LIKE) and fuzzy (word similarity) matching.
+sqlite - FTS5 table with trigram tokenizer for each searched table (kept in sync by triggers): substring matching.
+queries shorter than 3 characters (trigram) are matched as names prefix.
+"""
+import re
+import logging
+
+from sqlalchemy import text, inspect, or_, func, select, literal_column
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# niqqud and cantillation marks
+niqqud_re = re.compile('[\u0591-\u05bd\u05bf-\u05c7]')
+# geresh, gershayim and all the quotes that are used instead of them
+quotes_re = re.compile('[\'"`\u00b4\u05f3\u05f4\u2018\u2019\u201c\u201d\u201e\u2032\u2033]')
+# punctuation (including maqaf) is replaced by space. LIKE wildcards (% _) too, so queries never need escaping
+separators_re = re.compile('[\\s\\-\u05be.,;:/\\\\()\\[\\]*+!?%_]+')
+final_letters = {ord('ך'): 'כ', ord('ם'): 'מ', ord('ן'): 'נ', ord('ף'): 'פ', ord('ץ'): 'צ'}
+
+searched_tables = ('items', 'store_products')
+# pg_trgm is used only for queries of at least 3 characters (as the trigrams)
+min_query_length = 3
+
+
+def normalize_name(name):
+    """
+    normalized form of a name for search:
+    no niqqud and quotes, no final letters, lower case, punctuation replaced by single spaces
+
+    Args:
+        name(str):
+
+    Returns:
+        str
+    """
+    if name is None:
+        return None
+    name = niqqud_re.sub('', name)
+    name = quotes_re.sub('', name)
+    name = separators_re.sub(' ', name)
+    return name.translate(final_letters).lower().strip()
+
+
+def fts_table(table_name):
+    return '{}_search'.format(table_name)
+
+
+def create_search_schema(connection):
+    """
+    add search_name column to existing tables (filled from the names), and create the search indexes of the DB
+    """
+    inspector = inspect(connection)
+    for table_name in searched_tables:
+        if 'search_name' not in [column['name'] for column in inspector.get_columns(table_name)]:
+            connection.execute(text('ALTER TABLE {} ADD COLUMN search_name TEXT'.format(table_name)))
+            fill_search_names(connection, table_name)
+    if connection.dialect.name == 'postgresql':
+        create_trigram_indexes(connection)
+    elif connection.dialect.name == 'sqlite':
+        create_fts_tables(connection)
+
+
+def fill_search_names(connection, table_name, page_size=10000):
+    """
+    set search_name of all rows from their names
+    """
+    logger.info('filling {} search names'.format(table_name))
+    last_id = 0
+    while True:
+        rows = connection.execute(text('SELECT id, name FROM {} WHERE id > :last_id ORDER BY id LIMIT :limit'
+                                       .format(table_name)), {'last_id': last_id, 'limit': page_size}).fetchall()
+        if not rows:
+            break
+        connection.execute(text('UPDATE {} SET search_name = :search_name WHERE id = :id'.format(table_name)),
+                           [{'id': row_id, 'search_name': normalize_name(name)} for row_id, name in rows])
+        last_id = rows[-1][0]
+
+
+def create_trigram_indexes(connection):
+    """
+    postgres: pg_trgm GIN index on search_name, for LIKE '%x%' and similarity operators
+    """
+    try:
+        with connection.begin_nested():
+            connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    except Exception:
+        logger.warn("Couldn't create pg_trgm extension, names search will not be indexed")
+        return
+    for table_name in searched_tables:
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_{0}_search_name_trgm ON {0} '
+                                'USING gin (search_name gin_trgm_ops)'.format(table_name)))
+
+
+def create_fts_tables(connection):
+    """
+    sqlite: FTS5 table (trigram tokenizer) with the search names of each table, updated by triggers
+    """
+    for table_name in searched_tables:
+        search_table = fts_table(table_name)
+        if connection.dialect.has_table(connection, search_table):
+            continue
+        try:
+            connection.execute(text("CREATE VIRTUAL TABLE {} USING fts5(search_name, content='{}', content_rowid='id', "
+                                    "tokenize='trigram')".format(search_table, table_name)))
+        except Exception:
+            logger.warn("Couldn't create FTS5 table {} (no fts5 trigram support), names search will not be indexed"
+                        .format(search_table))
+            return
+        connection.execute(text(
+            'CREATE TRIGGER {0}_insert AFTER INSERT ON {1} BEGIN '
+            'INSERT INTO {0} (rowid, search_name) VALUES (new.id, new.search_name); END'.format(search_table,
+                                                                                              table_name)))
+        connection.execute(text(
+            'CREATE TRIGGER {0}_delete AFTER DELETE ON {1} BEGIN '
+            "INSERT INTO {0} ({0}, rowid, search_name) VALUES ('delete', old.id, old.search_name); END"
+            .format(search_table, table_name)))
+        connection.execute(text(
+            'CREATE TRIGGER {0}_update AFTER UPDATE OF search_name ON {1} BEGIN '
+            "INSERT INTO {0} ({0}, rowid, search_name) VALUES ('delete', old.id, old.search_name); "
+            'INSERT INTO {0} (rowid, search_name) VALUES (new.id, new.search_name); END'.format(search_table,
+                                                                                              table_name)))
+        connection.execute(text("INSERT INTO {0} ({0}) VALUES ('rebuild')".format(search_table)))
+
+
+def name_condition(db, model, name):
+    """
+    condition for rows of model whose name contains the name (postgres: or is similar to it)
+
+    Args:
+        db: SessionController
+        model: Item or StoreProduct
+        name: searched (partial) name
+
+    Returns:
+        sqlalchemy condition
+    """
+    query = normalize_name(name)
+    if len(query) < min_query_length:
+        return model.search_name.startswith(query, autoescape=True)
+    contains = model.search_name.contains(query)
+    if not is_indexed(db):
+        return contains
+    if db.engine.dialect.name == 'postgresql':
+        # word_similarity(query, search_name) above pg_trgm.word_similarity_threshold
+        return or_(contains, model.search_name.op('%>')(query))
+    # LIKE on FTS5 trigram table is answered by the index, but only without ESCAPE clause (no autoescape here,
+    # normalize_name removes the LIKE wildcards from the query)
+    return model.id.in_(select([literal_column('rowid')]).select_from(text(fts_table(model.__tablename__)))
+                        .where(literal_column('search_name').contains(query)))
+
+
+def name_order(db, model, name):
+    """
+    order of search results: most similar names first (postgres with pg_trgm), shortest names first (otherwise)
+    """
+    if db.engine.dialect.name == 'postgresql' and is_indexed(db):
+        return func.word_similarity(normalize_name(name), model.search_name).desc()
+    return func.length(model.search_name)
+
+
+def fts_plan(db, query):
+    """
+    sqlite: the plan of the FTS5 search tables in the query plan
+
+    Args:
+        db: SessionController
+        query: sqlalchemy Query
+
+    Returns:
+        list(str): plan details of the search tables scans. 'SCAN <table> VIRTUAL TABLE INDEX 0:L0' is an index
+        search (LIKE), without the L constraint ('INDEX 0:') the whole table is scanned
+    """
+    compiled = query.statement.compile(db.engine)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), [compiled.params[name] for name in compiled.positiontup])
+    search_tables = [fts_table(table_name) for table_name in searched_tables]
+    return [row[-1] for row in cursor.fetchall() if any(table in row[-1] for table in search_tables)]
+
+
+indexed_dbs = {}  # DB url: names search is indexed (pg_trgm extension / FTS5 tables exist)
+
+
+def is_indexed(db):
+    """
+    Args:
+        db: SessionController
+
+    Returns:
+        bool: True if the search indexes of the DB exist (see create_search_schema)
+    """
+    key = str(db.engine.url)
+    try:
+        return indexed_dbs[key]
+    except KeyError:
+        pass
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        indexed = db.execute(text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")).scalar()
+    elif dialect == 'sqlite':
+        connection = db.session.connection()
+        indexed = all(connection.dialect.has_table(connection, fts_table(table_name))
+                      for table_name in searched_tables)
+    else:
+        indexed = False
+    indexed_dbs[key] = indexed
+    return indexed
@@ -1,17 +1,30 @@
 # -*- coding: utf-8 -*-
+import io
+import os
+import csv
+import time
+import sqlite3
 import logging
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
 from enum import Enum
 # from datetime import datetime
 import datetime
-from sqlalchemy import create_engine, or_, and_, select
+from sqlalchemy import create_engine, event, or_, and_, select, bindparam, literal_column, text
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Date, DECIMAL, Text,\
-    exists, UniqueConstraint, Boolean, func
+    exists, UniqueConstraint, Boolean, func, Table, MetaData, Index
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.types import Enum as SqlEnum
+from sqlalchemy.dialects.postgresql import insert as postgres_insert
 from sqlalchemy.inspection import inspect
 from sqlalchemy.ext.compiler import compiles
 
+import partitions
+import search
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -38,6 +51,14 @@ dbs = {
 }
 db = dbs['postgres_development']
 # db = dbs['postgres_parallel']
+# postgres only: create price_history as monthly partitioned table (see partitions.py)
+history_partitions = False
+# read only copy of the DB for the UI (postgres replica, or sqlite snapshot file). None - the UI reads from db
+read_db = None
+# max seconds the read DB may be behind db, reads go to db when it is more behind. None - no limit
+max_read_staleness = None
+# sqlite only: snapshot file of db that is copied after each commit (stand-in for a replica, for testing)
+snapshot_db = None
 
 if 'sqlite' in db:
     BigInteger = MyBigInteger
@@ -140,6 +161,10 @@ class Store(Base):
         return hash(self.id)
 
 
+def search_name_default(context):
+    return search.normalize_name(context.current_parameters.get('name'))
+
+
 class Item(Base):
     __tablename__ = 'items'
 
@@ -149,6 +174,7 @@ class Item(Base):
     unit = Column(SqlEnum(Unit))
     # TODO: not as discussed, but I think it makes sense to have single unified name the same as for unit and quantity
     name = Column(Text, index=True)
+    search_name = Column(Text, default=search_name_default)  # see search.py
 
     store_products = relationship('StoreProduct', backref='item', lazy='joined')
 
@@ -178,6 +204,7 @@ class StoreProduct(Base):
     # saving the quantity/unit_qty for cases that auto parsing don't work, to allow manual parsing
     quantity = Column(Text)
     unit = Column(Text)
+    search_name = Column(Text, default=search_name_default)  # see search.py
 
     UniqueConstraint(store_id, code)
 
@@ -214,6 +241,8 @@ class PriceHistory(Base):
     price = Column(DECIMAL(precision=10, scale=2))
 
     UniqueConstraint(start_date, store_product_id)
+    # open entries (current prices) lookup
+    Index('ix_price_history_open', store_product_id, postgresql_where=end_date == None, sqlite_where=end_date == None)
 
     def __repr__(self):
         return '{}: {}<->{} = {}'.format(self.store_product.name, self.start_date, self.end_date if self.end_date is not None
@@ -311,20 +340,236 @@ class PriceFunction(Base):
 # """
 
 
+class FileType(Enum):
+    stores = 1
+    prices = 2
+    promos = 3
+
+
+class IngestedFile(Base):
+    """
+    Record of a chain file that was ingested to the DB, used for skipping files with unchanged content
+    """
+    __tablename__ = 'ingested_files'
+
+    id = Column(BigInteger, primary_key=True)
+    chain_id = Column(Integer, ForeignKey(Chain.id), index=True)
+    store_id = Column(BigInteger, ForeignKey(Store.id), nullable=True, index=True)  # None for chain files (stores)
+    file_type = Column(SqlEnum(FileType))
+    file_date = Column(Date)
+    ingest_date = Column(Date, default=datetime.date.today)
+    digest = Column(String)
+
+    def __repr__(self):
+        return '{} {} ({}): {}'.format(self.file_type.name, self.store_id or self.chain_id, self.file_date, self.digest)
+
+
+
 
 
+def copy_value(value):
+    """
+    Convert python value to its postgres COPY csv representation
+    Args:
+        value:
+
+    Returns:
+        str
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, Enum):  # enums are saved by name (see SqlEnum)
+        return value.name
+    return value
+
+
+# engine of this process, shared by all its sessions (see init_process_engine)
+process_engine = None
+# DB stats of this process: number of opened connections, and engines setup time (seconds)
+engine_stats = Counter()
+
+
+def count_connection(dbapi_connection, connection_record):
+    engine_stats['db_connections'] += 1
+
+
+def create_db_engine(db_path=db, db_logging=False, pool_size=None, pre_ping=False):
+    """
+    Create engine, and count its new connections in engine_stats
+    Args:
+        db_path: DB url
+        db_logging: log all SQL statements
+        pool_size: max number of idle connections kept open by the engine (default of sqlalchemy if None)
+        pre_ping: test connections before using them (reconnect if the DB server dropped them)
+
+    Returns:
+        Engine
+    """
+    options = {'echo': db_logging, 'pool_pre_ping': pre_ping}
+    if pool_size is not None and not db_path.startswith('sqlite'):  # sqlite pools have no size
+        options['pool_size'] = pool_size
+    engine = create_engine(db_path, **options)
+    event.listen(engine, 'connect', count_connection)
+    return engine
+
+
+def init_process_engine(db_path=db, pool_size=1, pre_ping=True):
+    """
+    Initializer of worker processes (multiprocessing Pool initializer): create the engine of the process and open
+    its first connection. sessions of the process (SessionController(engine=process_engine)) reuse it.
+    the schema is not checked here, it is done once by the parent process
+
+    Args:
+        db_path: DB url
+        pool_size: connections per process
+        pre_ping: test connections before using them
+    """
+    global process_engine
+    start = time.time()
+    engine_stats.clear()  # stats of the parent, in forked processes
+    process_engine = create_db_engine(db_path, pool_size=pool_size, pre_ping=pre_ping)
+    process_engine.connect().close()
+    engine_stats['db_setup_time'] += time.time() - start
+    logger.info('process DB engine connected: {}'.format(db_path))
+
+
+def pop_engine_stats():
+    """
+    Returns:
+        Counter: DB stats of this process since the last call
+    """
+    stats = Counter(engine_stats)
+    engine_stats.clear()
+    return stats
+
+
+class ReadReplica(object):
+    """
+    Read only copy of the DB, for queries that can use slightly stale data (see SessionController.read_query).
+
+    postgres - streaming replica, its lag is measured by the last replayed transaction.
+    sqlite - snapshot file of the DB (see SessionController.take_snapshot), its lag is the time between the last
+    change of the DB file and the snapshot.
+    """
+    def __init__(self, read_path, db_path, max_staleness=None, check_interval=5):
+        """
+        Args:
+            read_path: url of the read DB
+            db_path: url of the DB it is copied from
+            max_staleness: max seconds behind the DB to still be used. None - no limit
+            check_interval: seconds between lag checks
+        """
+        logger.info('connecting to read DB: {}'.format(read_path))
+        self.engine = create_db_engine(read_path)
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+        self.db_path = db_path
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self.last_check = None
+        self.fresh = True
+
+    def lag(self):
+        """
+        Returns:
+            float: seconds the read DB is behind the DB
+        """
+        if self.engine.dialect.name == 'postgresql':
+            return float(self.session.execute(text(
+                'SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+                'THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')).scalar() or 0)
+        if self.engine.dialect.name == 'sqlite':
+            snapshot_file = make_url(self.engine.url).database
+            db_file = make_url(self.db_path).database
+            return max(0., os.path.getmtime(db_file) - os.path.getmtime(snapshot_file))
+        return 0.
+
+    def is_fresh(self):
+        """
+        check (at most once in check_interval) if the read DB is fresh enough to be used.
+        on each check the read session starts new transaction, to see the latest data of the read DB
+
+        Returns:
+            bool
+        """
+        now = time.time()
+        if self.last_check is None or now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self.session.rollback()
+            if self.max_staleness is not None:
+                lag = self.lag()
+                self.fresh = lag <= self.max_staleness
+                if not self.fresh:
+                    logger.warn('read DB is {:.0f} seconds behind, reading from DB'.format(lag))
+        return self.fresh
+
 
 class SessionController(object):
     """
     This is the DB access interface
     """
-    def __init__(self, db_path=db, db_logging=False):
-        logger.info('connecting to DB: {}'.format(db_path))
-        self.engine = create_engine(db_path, echo=db_logging)
+    def __init__(self, db_path=db, db_logging=False, engine=None, read_path=None, max_staleness=None,
+                 snapshot_path=None):
+        """
+        Args:
+            db_path: DB url
+            db_logging: log all SQL statements
+            engine: existing engine to use (e.g. process_engine), the DB schema is assumed to be checked already.
+                if None, a new engine is created and the schema is created/checked
+            read_path: url of read only copy of the DB for read_query (replica or snapshot). None - read from the DB
+            max_staleness: max seconds the read DB may be behind the DB (see ReadReplica)
+            snapshot_path: sqlite only: snapshot file that is copied from the DB after each commit
+                (default is snapshot_db)
+        """
+        if engine is None:
+            logger.info('connecting to DB: {}'.format(db_path))
+            start = time.time()
+            self.engine = create_db_engine(db_path, db_logging)
+            self.create_schema(history_partitions)
+            engine_stats['db_setup_time'] += time.time() - start
+            logger.info('DB connected')
+        else:
+            self.engine = engine
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
-        Base.metadata.create_all(self.engine)
-        logger.info('DB connected')
+        self.partitioned_history = None  # unknown until ensure_history_partitions is called
+        self.history_partitions = set()
+        self.staging_tables = {}  # name: Table, staging tables that were not dropped yet
+        self.replica = ReadReplica(read_path, db_path, max_staleness) if read_path else None
+        self.snapshot_path = snapshot_path or snapshot_db
+
+    def create_schema(self, partitioned_history=False):
+        """
+        Create the missing tables, and the missing indexes of existing tables
+        Args:
+            partitioned_history: create price history as partitioned table (postgres only, see partitions.py)
+        """
+        with self.engine.begin() as connection:
+            if partitioned_history and self.engine.dialect.name == 'postgresql' and \
+                    not self.engine.dialect.has_table(connection, PriceHistory.__tablename__):
+                # tables it references are created first
+                Base.metadata.create_all(connection, tables=[table for table in Base.metadata.sorted_tables
+                                                             if table is not PriceHistory.__table__])
+                partitions.create_partitioned_history(connection)
+            Base.metadata.create_all(connection)
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+            search.create_search_schema(connection)
+
+    def ensure_history_partitions(self, start_date, end_date):
+        """
+        Create the missing monthly partitions of price history for the dates range (if it is partitioned)
+        """
+        if self.engine.dialect.name != 'postgresql':
+            return
+        connection = self.session.connection()
+        if self.partitioned_history is None:
+            self.partitioned_history = partitions.is_partitioned(connection)
+            if self.partitioned_history:
+                self.history_partitions = partitions.get_partitions(connection)
+        if self.partitioned_history:
+            partitions.ensure_history_partitions(connection, start_date, end_date, self.history_partitions)
 
     def get_session(self):
         return self.session
@@ -340,6 +585,14 @@ class SessionController(object):
         """
         return self.session.query(*args)
 
+    def read_query(self, *args):
+        """
+        Query for read only use: from the read DB if there is one and it is fresh enough, otherwise from the DB
+        """
+        if self.replica is not None and self.replica.is_fresh():
+            return self.replica.session.query(*args)
+        return self.session.query(*args)
+
     def exists(self, obj_field, value):
         (ret, ), = self.session.query(exists().where(obj_field == value))
         return ret
@@ -353,12 +606,199 @@ class SessionController(object):
     def bulk_insert(self, objects):
         self.session.bulk_save_objects(objects)
 
+    def bulk_load(self, model, columns, rows):
+        """
+        Insert rows to the model table, the fastest way the DB supports:
+        postgres - COPY FROM STDIN of in memory csv buffer. other DBs - executemany of INSERT statement
+
+        Args:
+            model: ORM class (or Table)
+            columns: names of the columns in the rows
+            rows: sequence of tuples of values (in columns order)
+        """
+        if not rows:
+            return
+        self.session.flush()  # rows may depend on pending objects
+        table = getattr(model, '__table__', model)
+        if self.engine.dialect.name == 'postgresql':
+            self.copy_rows(table, columns, rows)
+        else:
+            self.insert_rows(table, columns, rows)
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Insert rows with postgres COPY (see bulk_load)
+        """
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([copy_value(value) for value in row])
+        buf.seek(0)
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+                table.name, ', '.join(columns)), buf)
+        finally:
+            cursor.close()
+
+    def insert_rows(self, table, columns, rows):
+        """
+        Insert rows with executemany (see bulk_load)
+        """
+        self.session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+    def upsert(self, model, keys, columns, rows, chunk_size=1000):
+        """
+        Insert rows to the model table, and update the existing rows (same unique key) whose values were changed.
+        postgres - INSERT ... ON CONFLICT DO UPDATE ... RETURNING. sqlite - INSERT OR IGNORE and UPDATE of changed rows.
+        unchanged rows are not written at all.
+
+        Args:
+            model: ORM class (or Table) with integer id primary key
+            keys: names of the columns of the unique constraint
+            columns: names of the columns in the rows (including the keys)
+            rows: sequence of tuples of values (in columns order), unique by keys
+            chunk_size: rows per statement
+
+        Returns:
+            list: (id, *key values) of the inserted rows
+        """
+        if not rows:
+            return []
+        self.session.flush()
+        table = getattr(model, '__table__', model)
+        if self.engine.dialect.name == 'postgresql':
+            upsert_rows = self.upsert_rows_postgres
+        else:
+            upsert_rows = self.upsert_rows_sqlite
+        inserted = []
+        updated = 0
+        for i in range(0, len(rows), chunk_size):
+            chunk_inserted, chunk_updated = upsert_rows(table, keys, columns, rows[i:i + chunk_size])
+            inserted.extend(chunk_inserted)
+            updated += chunk_updated
+        logger.info('{}: {} rows inserted, {} rows updated'.format(table.name, len(inserted), updated))
+        return inserted
+
+    def upsert_rows_postgres(self, table, keys, columns, rows):
+        """
+        Upsert rows with a single INSERT ... ON CONFLICT statement (see upsert)
+        Returns:
+            (inserted rows, number of updated rows)
+        """
+        statement = postgres_insert(table).values([dict(zip(columns, row)) for row in rows])
+        updated_columns = [column for column in columns if column not in keys]
+        if updated_columns:
+            excluded = statement.excluded
+            statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_=dict((column, excluded[column]) for column in updated_columns),
+                where=or_(*[table.c[column].is_distinct_from(excluded[column]) for column in updated_columns]))
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=keys)
+        # xmax is 0 only for rows that were inserted by this statement
+        statement = statement.returning(literal_column('xmax') == 0, table.c.id, *[table.c[key] for key in keys])
+        inserted = []
+        updated = 0
+        for row in self.session.execute(statement):
+            if row[0]:
+                inserted.append(tuple(row[1:]))
+            else:
+                updated += 1
+        return inserted, updated
+
+    def upsert_rows_sqlite(self, table, keys, columns, rows):
+        """
+        Upsert rows with INSERT OR IGNORE, and executemany UPDATE of the changed rows (see upsert).
+        new ids are larger than all existing ids (sqlite rowid), so the inserted rows are selected by id.
+        Returns:
+            (inserted rows, number of updated rows)
+        """
+        last_id = self.session.execute(select([func.max(table.c.id)])).scalar() or 0
+        self.session.execute(table.insert().prefix_with('OR IGNORE'), [dict(zip(columns, row)) for row in rows])
+
+        updated = 0
+        updated_columns = [column for column in columns if column not in keys]
+        if updated_columns:
+            # bind parameters can't have the names of the updated columns
+            statement = table.update() \
+                .where(and_(*[table.c[key] == bindparam('_' + key) for key in keys])) \
+                .where(or_(*[table.c[column].is_distinct_from(bindparam('_' + column)) for column in updated_columns])) \
+                .values(dict((column, bindparam('_' + column)) for column in updated_columns))
+            updated = self.session.execute(
+                statement, [dict(('_' + column, value) for column, value in zip(columns, row)) for row in rows]).rowcount
+
+        inserted = self.session.execute(select([table.c.id] + [table.c[key] for key in keys])
+                                        .where(table.c.id > last_id).order_by(table.c.id))
+        return [tuple(row) for row in inserted], updated
+
     def bulk_update(self, mapper, mappings):
         self.session.bulk_update_mappings(mapper, mappings)
 
+    @contextmanager
+    def staging_table(self, name, *columns):
+        """
+        Temporary table for set based statements (load it with bulk_load, then join it in UPDATE / INSERT ... SELECT).
+        the table lives in the connection of the current transaction, and is dropped on exit
+
+        Args:
+            name: table name
+            *columns: sqlalchemy Columns
+
+        Yields:
+            Table
+        """
+        self.session.flush()
+        connection = self.session.connection()
+        table = Table(name, MetaData(), *columns, prefixes=['TEMPORARY'])
+        table.create(connection)
+        self.staging_tables[name] = table
+        try:
+            yield table
+        except Exception:
+            try:
+                table.drop(connection)
+                del self.staging_tables[name]
+            except Exception:
+                pass  # failed transaction (postgres), the table is removed by its rollback (see rollback_savepoint)
+            raise
+        table.drop(connection)
+        del self.staging_tables[name]
+
+    def rollback_savepoint(self, savepoint):
+        """
+        roll back a savepoint (see session.begin_nested), with the state of what was done in it: the history
+        partitions it created are forgotten, and staging tables that were left (by failed statement) are dropped
+
+        Args:
+            savepoint: SessionTransaction of begin_nested
+        """
+        savepoint.rollback()
+        self.partitioned_history = None  # created partitions may be rolled back
+        connection = self.session.connection()
+        for table in self.staging_tables.values():
+            table.drop(connection, checkfirst=True)
+        self.staging_tables.clear()
+
+    def execute(self, statement):
+        """
+        Execute core statement in the current transaction
+        Returns:
+            ResultProxy
+        """
+        return self.session.execute(statement)
+
     def flush(self):
         self.session.flush()
 
+    def close(self):
+        """
+        close the session (uncommitted changes are discarded), its connection is returned to the engine pool
+        """
+        self.session.close()
+        if self.replica is not None:
+            self.replica.session.close()
+
     def commit(self):
         """
         Commit changes to the DB
@@ -371,10 +811,42 @@ class SessionController(object):
         except Exception:
             logger.exception('Commit to DB failed')
             self.session.rollback()
+            self.partitioned_history = None  # created partitions may be rolled back
+            self.staging_tables.clear()
             return False
         logger.info('Commit ended successfully')
+        if self.snapshot_path and self.engine.dialect.name == 'sqlite':
+            self.take_snapshot(self.snapshot_path)
         return True
 
+    def take_snapshot(self, snapshot_path):
+        """
+        sqlite only: copy the DB to snapshot file (with the sqlite backup API, so the copy is consistent).
+        the copy is written to unique temporary file (next to the snapshot, so concurrent snapshots don't write to the
+        same file) that replaces the snapshot, so readers never see partial snapshot
+
+        Args:
+            snapshot_path: url (or path) of the snapshot file
+        """
+        snapshot_file = make_url(snapshot_path).database if '://' in snapshot_path else snapshot_path
+        fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(snapshot_file)))
+        os.close(fd)
+        try:
+            source = self.engine.raw_connection()
+            try:
+                target = sqlite3.connect(temp_file)
+                try:
+                    source.connection.backup(target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            os.replace(temp_file, snapshot_file)
+        except Exception:
+            os.remove(temp_file)
+            raise
+        logger.info('DB snapshot saved to {}'.format(snapshot_file))
+
     def update(self, model, update_dict):
         """
         session.query(Stuff).update({Stuff.foo: Stuff.foo + 1})
@@ -3,6 +3,9 @@ import logging
 from datetime import date
 from sql_interface import Chain, Store, Item, CurrentPrice, PriceHistory, SessionController, StoreProduct, or_
 import xml_parser
+import sql_interface
+import search
+import archive
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -132,17 +135,19 @@ class ShopPlanner(object):
 
 class UI(object):
     def __init__(self, db=None):
-        self.db = db or SessionController()
+        # all UI queries are read only, so they can use the read DB (replica / snapshot) if there is one
+        self.db = db or SessionController(read_path=sql_interface.read_db,
+                                          max_staleness=sql_interface.max_read_staleness)
         self.page_size = 10000
 
     def get_cities(self):
-        return [c for c, in self.db.query(Store.city).distinct().order_by(Store.city).all()]
+        return [c for c, in self.db.read_query(Store.city).distinct().order_by(Store.city).all()]
 
     def get_chains(self):
-        return self.db.query(Chain).order_by(Chain.name).all()
+        return self.db.read_query(Chain).order_by(Chain.name).all()
 
     def get_chain_stores(self, chain):
-        return [store for store in self.db.query(Store).join(Chain).filter(Store.chain_id == chain.id).all()]
+        return [store for store in self.db.read_query(Store).join(Chain).filter(Store.chain_id == chain.id).all()]
 
     def get_city_stores(self, city):
         """
@@ -153,7 +158,7 @@ class UI(object):
         Returns:
 
         """
-        q = self.db.query(Store)
+        q = self.db.read_query(Store)
         return self.db.filter_or(q, [Store.city == city, Store.name.contains(city)]).all()
 
     def get_current_products(self, store):
@@ -165,11 +170,23 @@ class UI(object):
         Returns:
 
         """
-        return self.db.query(CurrentPrice).join(StoreProduct).filter(StoreProduct.store_id == store.id)
+        return self.db.read_query(CurrentPrice).join(StoreProduct).filter(StoreProduct.store_id == store.id)
 
     def get_product_history(self, product):
-        return self.db.query(PriceHistory).filter(PriceHistory.store_product_id == product.store_product_id). \
+        """
+        get price history of store product (from the DB and from the archive)
+        Args:
+            product: CurrentPrice (or other object with store_product_id)
+
+        Returns:
+            list: PriceHistory and ArchivedPriceHistory entries, ordered by start date
+        """
+        entries = self.db.read_query(PriceHistory).filter(PriceHistory.store_product_id == product.store_product_id). \
             order_by(PriceHistory.start_date.asc()).yield_per(self.page_size)
+        # only the archive partitions of the product chain are read
+        chain_id = self.db.read_query(Store.chain_id).join(StoreProduct, StoreProduct.store_id == Store.id) \
+            .filter(StoreProduct.id == product.store_product_id).scalar()
+        return archive.merge_history(entries, archive.read_history([product.store_product_id], [chain_id]))
 
     def find_product_in_other_stores(self, store_product, *stores):  # TODO, *stores or stores
         """
@@ -184,25 +201,25 @@ class UI(object):
         """
         if store_product.item_id is None:
             logger.warn("no item id for {}. (store_product_id is {})".format(store_product, store_product.id))
-        return self.db.query(StoreProduct).join(Item).filter(Item.id == store_product.item_id)
+        return self.db.read_query(StoreProduct).join(Item).filter(Item.id == store_product.item_id)
 
     def history2store_product(self, history_product):
-        return self.db.query(StoreProduct).filter(StoreProduct.id == history_product.store_product_id).one()
+        return self.db.read_query(StoreProduct).filter(StoreProduct.id == history_product.store_product_id).one()
 
     def get_items_with_partial_name_match(self, partial_name):
-        return self.db.query(Item).filter(
-            Item.name.like('{}%'.format(partial_name))).all()  # .yield_per(self.page_size)
-        # TODO: is Item.name.contains has better performance?
+        return self.db.read_query(Item).filter(search.name_condition(self.db, Item, partial_name)) \
+            .order_by(search.name_order(self.db, Item, partial_name)).all()  # .yield_per(self.page_size)
 
     def get_store_products_by_name(self, name, store_id):
-        q = self.db.query(StoreProduct).filter(StoreProduct.store_id == store_id).filter(
-            Item.name.like('{}%'.format(name)))
+        q = self.db.read_query(StoreProduct).filter(StoreProduct.store_id == store_id).filter(
+            search.name_condition(self.db, StoreProduct, name)).order_by(search.name_order(self.db, StoreProduct, name))
         return q.limit(10).all()  # yield_per(self.page_size) # TODO
 
     def get_store_current_products_by_name(self, name, store_id, limit=None):
-        q = self.db.query(StoreProduct).join(CurrentPrice) \
+        q = self.db.read_query(StoreProduct).join(CurrentPrice) \
             .filter(StoreProduct.store_id == store_id) \
-            .filter(StoreProduct.name.like('{}%'.format(name)))
+            .filter(search.name_condition(self.db, StoreProduct, name)) \
+            .order_by(search.name_order(self.db, StoreProduct, name))
         return q.limit(limit) if limit else q.all()
 
     def get_stores_current_items_by_name(self, name, store_ids, limit=None):
@@ -210,23 +227,23 @@ class UI(object):
             return # TODO...
 
         stores_cond = [StoreProduct.store_id == store_id for store_id in store_ids]
-        q = self.db.query(Item).join(StoreProduct).join(CurrentPrice)
+        q = self.db.read_query(Item).join(StoreProduct).join(CurrentPrice)
         q = self.db.filter_or(q, stores_cond)
-        q = q.filter(Item.name.like('{}%'.format(name)))
+        q = q.filter(search.name_condition(self.db, Item, name)).order_by(search.name_order(self.db, Item, name))
         return q.limit(limit).all() if limit else q.all()
 
     def get_item_by_code(self, item_code):
-        return self.db.query(Item).filter(Item.code == item_code).one()
+        return self.db.read_query(Item).filter(Item.code == item_code).one()
 
     def get_item_by_id(self, item_id):
-        return self.db.query(Item).filter(Item.id == item_id).one()
+        return self.db.read_query(Item).filter(Item.id == item_id).one()
 
     def get_store_by_id(self, store_id):
         return self.get_stores_by_ids([store_id])[0]
 
     def get_stores_by_ids(self, stores_ids):
         stores_ids = map(int, stores_ids)
-        q = self.db.query(Store)
+        q = self.db.read_query(Store)
         conds = [Store.id == store_id for store_id in stores_ids]
         return self.db.filter_or(q, conds).all()
 
@@ -240,7 +257,7 @@ class UI(object):
         Returns:
 
         """
-        q = self.db.query(StoreProduct)
+        q = self.db.read_query(StoreProduct)
         if stores is not None:
             conds = [StoreProduct.store_id == store.id for store in stores]
             q = self.db.filter_or(q, conds)
@@ -256,7 +273,7 @@ class UI(object):
         Returns:
 
         """
-        q = self.db.query(CurrentPrice).join(StoreProduct)
+        q = self.db.read_query(CurrentPrice).join(StoreProduct)
         if stores is not None:
             conds = [StoreProduct.store_id == store.id for store in stores]
             q = self.db.filter_or(q, conds)
@@ -264,19 +281,29 @@ class UI(object):
 
     def item2history_products(self, item, stores=None):
         """
-        get all store products that are linked to given item
+        get price history of all store products that are linked to given item (from the DB and from the archive)
 
         Args:
             item:
             stores: optional. filter by list of store ids
         Returns:
-
+            list: PriceHistory and ArchivedPriceHistory entries, ordered by store product
         """
-        q = self.db.query(PriceHistory).join(StoreProduct)
+        q = self.db.read_query(PriceHistory).join(StoreProduct)
+        products_q = self.db.read_query(StoreProduct)
         if stores is not None:
             conds = [StoreProduct.store_id == store.id for store in stores]
             q = self.db.filter_or(q, conds)
-        return q.filter(StoreProduct.item_id == item.id).order_by(PriceHistory.store_product_id).all()  # yield_per(self.page_size)
+            products_q = self.db.filter_or(products_q, conds)
+        entries = q.filter(StoreProduct.item_id == item.id).order_by(PriceHistory.store_product_id).all()  # yield_per(self.page_size)
+
+        products = dict((product.id, product) for product in products_q.filter(StoreProduct.item_id == item.id))
+        chain_ids = [store.chain_id for store in stores] if stores is not None else None
+        archived_entries = archive.read_history(products, chain_ids)
+        for entry in archived_entries:
+            entry.store_product = products[entry.store_product_id]
+        return archive.merge_history(entries, archived_entries,
+                                     key=lambda entry: (entry.store_product_id, entry.start_date))
 
     def product2item(self, store_product):
         """
@@ -288,10 +315,10 @@ class UI(object):
 
         """
         if store_product.external:
-            return self.db.query(Item).filter(Item.code == store_product.code).one()
+            return self.db.read_query(Item).filter(Item.code == store_product.code).one()
         else:
             # try:  TODO add handling
-            return self.db.query(Item).filter(Item.id == store_product.item_id).one()
+            return self.db.read_query(Item).filter(Item.id == store_product.item_id).one()
             # except
 
     def products2items(self, products):
@@ -304,7 +331,7 @@ class UI(object):
 
         """
         if products:
-            q = self.db.query(Item)
+            q = self.db.read_query(Item)
             conditions = [Item.code == p.code if p.is_external() else Item.id == p.item_id for p in products]
             return self.db.filter_or(q, conditions).all()
 
@@ -317,7 +344,7 @@ class UI(object):
         Returns:
 
         """
-        return self.db.query(Store).filter(Store.id == product.store_id).one()
+        return self.db.read_query(Store).filter(Store.id == product.store_id).one()
 
 
 def find_products_with_history(db, stores=None):
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 import os
 import re
+import json
+import time
 import logging
+import tempfile
+import threading
+from collections import Counter, namedtuple
 from datetime import date
+from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import unicodedata
 from enum import Enum
 from bs4 import BeautifulSoup
 import xml_parser
-from sql_interface import Chain, ChainWebAccess, SessionController
+import downloader
+import listing
+from sql_interface import Chain, ChainWebAccess, SessionController, FileType
 
 # remove annoying logger prints from requests
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
@@ -43,6 +53,213 @@ full_file_pattern = re.compile(re.sub(re.escape('Full)?'), r'Full)', file_patter
 price_file_pattern = re.compile(re.sub(re.escape('(?P<type>Stores|Promo|Price(s)?)'), r'(?P<type>Price(s)?)', full_file_pattern.pattern))
 promo_file_pattern = re.compile(re.sub(re.escape('(?P<type>Stores|Promo|Price(s)?)'), r'(?P<type>Promo)', full_file_pattern.pattern))
 
+# files that are still written (downloads, temporary files), their names match file_pattern but they are not chain files
+partial_suffixes = (downloader.part_suffix, '.tmp')
+
+
+class FileCatalog(object):
+    """
+    Index of the chain files in a folder (and its sub folders).
+
+    Each file name is parsed once with file_pattern, and indexed by (type, chain full id, store id, date), so finding
+    the file of a store doesn't require walking the folder. Only the newest file (by time) of each date is kept.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.files = {}  # (type, full id, store id, date): (full date, path)
+        self.newest_files = {}  # (type, full id, store id): (full date, path)
+        self.scanned = False
+
+    @staticmethod
+    def file_key(file_name):
+        """
+        get the index key of a file name
+        Args:
+            file_name:
+
+        Returns:
+            tuple: (type, full id, store id, date), full date. None if the file is not a chain file
+        """
+        if file_name.endswith(partial_suffixes):
+            return None
+        m = file_pattern.match(file_name)
+        if not m:
+            return None
+        file_type = m.group('type').lower()
+        if file_type.startswith('store'):
+            file_type = FileType.stores
+            store_id = None  # stores files are chain files
+        elif m.group('full'):  # only full prices and promos files are used
+            file_type = FileType.prices if file_type.startswith('price') else FileType.promos
+            store_id = int(m.group('store')) if m.group('store') else None
+        else:
+            return None
+        return (file_type, int(m.group('id')), store_id, m.group('date')), m.group('full_date')
+
+    def scan(self):
+        """
+        index all files in the folder
+        """
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            for f in filenames:
+                self.add(os.path.join(dirpath, f))
+        self.scanned = True
+
+    def add(self, file_path):
+        """
+        add a file to the catalog (if it is a chain file)
+        Args:
+            file_path: path to the file
+        """
+        key = self.file_key(os.path.basename(file_path))
+        if key is None:
+            return
+        key, full_date = key
+        for index, index_key in ((self.files, key), (self.newest_files, key[:-1])):
+            if index_key not in index or index[index_key][0] <= full_date:
+                index[index_key] = (full_date, file_path)
+
+    def get(self, file_type, full_id, store_id=None, d=None):
+        """
+        get the newest file of given parameters
+        Args:
+            file_type (FileType):
+            full_id: chain full id
+            store_id: store id (not for stores files)
+            d: file date. if None - the newest file of any date
+
+        Returns:
+            str: path to file, None if there is no such file
+        """
+        if not self.scanned:
+            self.scan()
+        if file_type == FileType.stores:
+            store_id = None
+        else:
+            store_id = int(store_id)
+        if d is None:
+            res = self.newest_files.get((file_type, int(full_id), store_id))
+        else:
+            res = self.files.get((file_type, int(full_id), store_id, '{:04}{:02}{:02}'.format(d.year, d.month, d.day)))
+        if res is not None:
+            return res[1]
+
+
+file_catalogs = {}
+
+
+def get_file_catalog(folder):
+    """
+    get the (per process) catalog of the given chain folder
+    Args:
+        folder: chain folder path
+
+    Returns:
+        FileCatalog
+    """
+    folder = os.path.normpath(folder)
+    try:
+        return file_catalogs[folder]
+    except KeyError:
+        catalog = file_catalogs[folder] = FileCatalog(folder)
+        return catalog
+
+
+# chain is the chain name, for listings of files of more than one chain (None for listings of single chain)
+ManifestEntry = namedtuple('ManifestEntry', ('name', 'url', 'size', 'timestamp', 'chain'), defaults=(None,))
+manifest_ttl = 30 * 60  # seconds a cached remote listing is used before it is fetched again
+
+
+class ListingManifest(object):
+    """
+    Files listing of a remote folder: (name, url, size, timestamp) of each chain file in it.
+
+    The listing is fetched once and cached in a json file (in the chain folder) for manifest_ttl seconds, so finding
+    the files of a pattern doesn't cost HTTP requests. size is as reported by the listing (None if it isn't), and
+    timestamp is taken from the file name (YYYYMMDDHHMM).
+    """
+    def __init__(self, cache_path, fetch, ttl=None):
+        """
+        Args:
+            cache_path: path of the json cache file
+            fetch: function that fetches the listing, returns list(ManifestEntry)
+            ttl: seconds (default is manifest_ttl)
+        """
+        self.cache_path = cache_path
+        self.fetch = fetch
+        self.ttl = manifest_ttl if ttl is None else ttl
+        self.entries = None
+
+    def load(self):
+        """
+        load the cached listing if it is not older than the ttl
+        Returns:
+            bool: True if the listing was loaded
+        """
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - cache['fetched'] > self.ttl:
+            return False
+        self.entries = [ManifestEntry(*entry) for entry in cache['entries']]
+        return True
+
+    def refresh(self):
+        """
+        fetch the listing, and cache it (empty listings are not cached, the files may not be published yet). the cache
+        is written to unique temporary file that replaces it, so processes refreshing the same listing don't clobber
+        each other's file
+        """
+        self.entries = list(self.fetch())
+        if self.entries:
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.cache_path)))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'fetched': time.time(), 'entries': self.entries}, f)
+                os.replace(temp_path, self.cache_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+
+    def get_entries(self):
+        if self.entries is None and not self.load():
+            self.refresh()
+        return self.entries
+
+    def match(self, pattern):
+        """
+        get the entries whose file name matches the pattern
+        Args:
+            pattern (re.pattern):
+
+        Returns:
+            list(ManifestEntry)
+        """
+        return [entry for entry in self.get_entries() if pattern.match(entry.name)]
+
+
+class ChainListingManifest(object):
+    """
+    The files of one chain in a (shared) listing of the files of many chains, with the interface of ListingManifest
+    """
+    def __init__(self, manifest, chain_name):
+        """
+        Args:
+            manifest: ListingManifest of all the chains files (entries with chain name)
+            chain_name:
+        """
+        self.manifest = manifest
+        self.chain_name = chain_name
+
+    def get_entries(self):
+        return [entry for entry in self.manifest.get_entries() if entry.chain == self.chain_name]
+
+    def match(self, pattern):
+        return [entry for entry in self.get_entries() if pattern.match(entry.name)]
+
+
 # this magic code is for handling the additional Unicode characters in some of the chain names (in MOE webpage)
 def filter_non_printable(s):
     """
@@ -61,28 +278,167 @@ def filter_non_printable(s):
     return u''.join(result).replace(u'#', u' ')
 
 
-def bs_parse_url(url):
+http_pool_size = None  # kept alive connections per host, None for the concurrent downloads per host
+http_timeout = (10, 120)  # (connect, read) seconds
+http_stats = Counter()  # requests and opened connections of all the sessions of the process
+http_stats_lock = threading.Lock()
+
+
+def count_http(**counts):
+    with http_stats_lock:
+        http_stats.update(counts)
+
+
+def pop_http_stats():
     """
-    get a BeautifulSoup parsed webpage from url
+    get the HTTP stats of this process (since last call)
+    Returns:
+        Counter: http_requests, http_connections (new connections, the other requests reused kept alive connections)
+    """
+    with http_stats_lock:
+        stats = Counter(http_stats)
+        http_stats.clear()
+    return stats
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        count_http(http_connections=1)
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        count_http(http_connections=1)
+        return super()._new_conn()
+
+
+class ScraperAdapter(HTTPAdapter):
+    """
+    keep alive connections pool of a scraper session, with default timeout and counting of requests and connections
+    """
+    def __init__(self, pool_size=None, timeout=None):
+        self.timeout = timeout or http_timeout
+        pool_size = pool_size or http_pool_size or downloader.max_host_connections
+        super().__init__(pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                                   'https': CountingHTTPSConnectionPool}
+
+    def send(self, request, timeout=None, **kwargs):
+        count_http(http_requests=1)
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def create_session(pool_size=None, timeout=None):
+    """
+    create requests session whose listing fetches and downloads reuse kept alive connections
     Args:
-        url:
+        pool_size: connections kept per host (default is http_pool_size)
+        timeout: default (connect, read) timeout of the requests (default is http_timeout)
 
     Returns:
+        requests.Session
+    """
+    session = requests.Session()
+    adapter = ScraperAdapter(pool_size, timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
+def configure_http(pool_size=None, timeout=None):
     """
+    set the HTTP settings of the process (before any scraper is created)
+    """
+    global http_pool_size, http_timeout, default_session
+    http_pool_size = pool_size or http_pool_size
+    http_timeout = timeout or http_timeout
+    default_session = None
+
+
+default_session = None
+
+
+def get_default_session():
+    """
+    get the (per process) session of the pages that are not fetched by a scraper (e.g. the gov chains page)
+    """
+    global default_session
+    if default_session is None:
+        default_session = create_session()
+    return default_session
+
+
+def get_page_text(url, session=None):
+    """
+    get the html of a webpage
+    Args:
+        url:
+        session: requests session to fetch with (default is get_default_session())
+
+    Returns:
+        str
+    """
+    session = session or get_default_session()
     try:
-        html = requests.get(url, verify=False)
+        html = session.get(url, verify=False)
     except requests.exceptions.SSLError:
-        html = requests.get(url, verify=False)  # TODO: fix SSL certification
-    return BeautifulSoup(html.text, 'html.parser')
+        html = session.get(url, verify=False)  # TODO: fix SSL certification
+    return html.text
+
+
+def bs_parse_url(url, session=None):
+    """
+    get a BeautifulSoup parsed webpage from url
+    Args:
+        url:
+        session: requests session to fetch with (default is get_default_session())
+
+    Returns:
+
+    """
+    return BeautifulSoup(get_page_text(url, session), 'html.parser')
+
+
+def parse_listing_url(url, session=None):
+    """
+    get a listing webpage from url, parsed for links extraction (see listing module)
+    Args:
+        url:
+        session: requests session to fetch with (default is get_default_session())
+
+    Returns:
+        lxml.html.HtmlElement
+    """
+    return listing.parse_page(get_page_text(url, session))
 
 
 def bs_parse_page(text):
     return BeautifulSoup(text, 'html.parser')
 
+scrapers = {}  # (name, url, username, password): ChainScraper of this process
+
+
 def db_chain_factory(chain):
+    """
+    get the scraper of a DB chain. the scrapers are kept per process, so all the downloads of a chain (and its
+    subchains) reuse the same logged in session
+    Args:
+        chain: DB Chain
+
+    Returns:
+        ChainScraper: None if there is no scraper for the chain site
+    """
     web_access = chain.web_access
-    return web_scraper_factory(chain.name, web_access.url, web_access.username, web_access.password)
+    key = (chain.name, web_access.url, web_access.username, web_access.password)
+    try:
+        return scrapers[key]
+    except KeyError:
+        scraper = scrapers[key] = web_scraper_factory(*key)
+        return scraper
 
 def web_scraper_factory(name, url, username, password):
     """
@@ -209,15 +565,49 @@ class ChainScraper(object):
 
     """
 
+    session_max_age = None  # seconds a logged in session is used before logging in again (None - never expires)
+
     def __init__(self, url, chain_name=None, username='', password=''):
         self.name = chain_name
         self.url = url
         # self.base_page = None
-        self.session = None
+        self.credentials = (url, username, password)
+        self.session = None  # logged in on first use, see get_session
+        self.login_time = None
         self.stores_items = {}
         self.stores = None
-        self.session = self.login(url, username, password)
-        self.id = self.get_chain_full_id()
+        self.manifests = {}  # manifest key: ListingManifest
+        self._id = None
+
+    @property
+    def id(self):
+        """
+        chain full id (found on first use, as it may require fetching the site)
+        """
+        if self._id is None:
+            self._id = self.get_chain_full_id()
+        return self._id
+
+    def get_session(self):
+        """
+        get the logged in session of the scraper (logs in on first use, and again when the session expires)
+        Returns:
+            requests.Session
+        """
+        if self.session is None or (self.session_max_age is not None and
+                                    time.time() - self.login_time > self.session_max_age):
+            self.refresh_session()
+        return self.session
+
+    def refresh_session(self):
+        """
+        log in again, with new session
+        """
+        logger.info('logging in to {} ({})'.format(self.name, self.url))
+        if self.session is not None:
+            self.session.close()
+        self.session = self.login(*self.credentials)
+        self.login_time = time.time()
 
     def login(self, url, user, password):
         """
@@ -227,7 +617,7 @@ class ChainScraper(object):
         :param password: password
         :return: A BeautifulSoup parsed page of the database
         """
-        s = requests.Session()
+        s = create_session()
         return s
 
     def get_chain_full_id(self):
@@ -260,16 +650,81 @@ class ChainScraper(object):
         pattern = self.set_pattern_date(full_file_pattern, file_d)
         return self.download_files_by_pattern(pattern, file_d)
 
+    def list_files(self, d=None):
+        """
+        fetch the remote listing of the chain files
+        Args:
+            d: date of the listing (for sites with folder per date)
+
+        Returns:
+            list(ManifestEntry)
+        """
+        raise NotImplementedError
+
+    def manifest_key(self, d=None):
+        """
+        key of the remote listing of the date (sites with folder per date have a listing for each date)
+        """
+        return 'all'
+
+    def get_manifest(self, d=None):
+        """
+        get the (cached) remote listing of the date
+        Returns:
+            ListingManifest
+        """
+        key = self.manifest_key(d)
+        try:
+            return self.manifests[key]
+        except KeyError:
+            cache_path = os.path.join(self.get_chain_folder(), '.manifest_{}.json'.format(key))
+            manifest = self.manifests[key] = ListingManifest(cache_path, lambda: self.list_files(d))
+            return manifest
+
+    @staticmethod
+    def manifest_entry(file_name, url, size=None):
+        """
+        get the listing entry of a file
+        Returns:
+            ManifestEntry: None if the file is not a chain file
+        """
+        m = file_pattern.match(file_name)
+        if m:
+            return ManifestEntry(file_name, url, size, m.group('full_date'))
+
+    def get_manifest_full_id(self, d=None):
+        """
+        get the chain full id from the name of a listed file
+        """
+        for entry in self.get_manifest(d).get_entries():
+            return file_pattern.match(entry.name).group('id')
+
+    def get_files_folder(self, d=None):
+        """
+        get the folder of the downloaded files of the date
+        """
+        return self.get_chain_folder()
+
     def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
         """
-        download all files that match the given pattern
+        download all files that match the given pattern (files that were already downloaded are not downloaded again)
         Args:
             pattern (re.pattern):
+            d: date of the listing
 
         Returns:
             list(str): list of paths to downloaded files
         """
-        raise NotImplementedError
+        folder = self.get_files_folder(d)
+        file_paths = []
+        downloads = []
+        for entry in self.get_manifest(d).match(pattern):
+            file_path = os.path.join(folder, entry.name)
+            file_paths.append(file_path)
+            if not os.path.exists(file_path):
+                downloads.append((entry.url, file_path))
+        self.download_urls(downloads)
+        return file_paths
 
     def download_url_to_path(self, url, file_path, session=None):
         """
@@ -282,15 +737,30 @@ class ChainScraper(object):
         Returns:
 
         """
-        session = session or self.session
-        with open(file_path, 'wb') as f:
-            res = session.get(url, stream=True, verify=False)
-            if not res.ok:
-                return  # error
-            for block in res.iter_content(1024*1000):
-                f.write(block)
+        session = session or self.get_session()
+        if downloader.get_downloader().download(session, url, file_path) is None:
+            return  # error
+        get_file_catalog(self.get_chain_folder()).add(file_path)
         return file_path
 
+    def download_urls(self, downloads, session=None):
+        """
+        download all given urls concurrently (see downloader.Downloader)
+        Args:
+            downloads: list of (url, file path)
+            session:
+
+        Returns:
+            list(str): paths of the downloaded files
+        """
+        session = session or self.get_session()
+        catalog = get_file_catalog(self.get_chain_folder())
+        file_paths = [file_path for file_path in downloader.get_downloader().download_all(session, downloads)
+                      if file_path is not None]
+        for file_path in file_paths:
+            catalog.add(file_path)
+        return file_paths
+
     @staticmethod
     def set_pattern_date(pattern, d):
         """
@@ -398,68 +868,42 @@ class Shufersal(ChainScraper):
         super().__init__(url='http://prices.shufersal.co.il/', chain_name='שופרסל')
 
     def login(self, url, user, password):
-        s = requests.Session()
+        s = create_session()
         s.get(url, verify=False)
         return s
 
     def get_chain_full_id(self):
-        page = bs_parse_url(self.url)
-        some_file = page.find('td', text=re.compile('Price')).string
-        return some_file.split('-')[0][re.search('\d', some_file).start():]
-
-    def get_stores_xml(self, d=None):
-        page = bs_parse_url(self.url)
-        last_page_url = page.find('a', text='>>')['href']
-        last_page = bs_parse_url(self.url + last_page_url)
-        url = last_page.find('a', {'href': re.compile('stores', flags=re.IGNORECASE)})['href']
-        file_path = url.split('/')[-1]  # drop all portal info
-        file_path = file_path[:file_path.index('?')]  # drop additional query info
-        file_path = os.path.join(self.get_chain_folder(), file_path)
-        return self.download_url_to_path(url, file_path)
+        return self.get_manifest_full_id()
 
     def download_all_data(self, d=None):
         # TODO: not implemented correctly!!!
         return self.download_files_by_pattern(pattern=full_file_pattern)
 
-    def get_prices_xml(self, store_id, pattern=price_file_pattern, d=None):
-        matches = list(filter(None.__ne__, [pattern.match(f) for f in os.listdir(self.get_chain_folder())]))
-        files = [m.string for m in matches if
-                 int(m.group('store')) == int(store_id) and
-                 m.group('date') == self.get_today_timestamp()]
-        if any(files):
-            return os.path.join(self.get_chain_folder(), files[0])
-
-        url = "http://prices.shufersal.co.il/FileObject/UpdateCategory?catID={}&storeId={}".format(
-            Shufersal.Categories.prices_full.value, store_id)
-        page = bs_parse_url(url)
-        url = [a['href'] for a in page.find_all('a') if pattern.match(a['href'])][0]
-        file_path = os.path.join(self.get_chain_folder(), url.split('?')[0].split('/')[-1])   # TODO add today dir also to path?
-        if not os.path.exists(file_path):
-            return self.download_url_to_path(url, file_path)
-        return file_path
-
-    def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
-        file_paths = []
-        page = bs_parse_url(self.url)
-        while page.find('a', text='>'):
-            refs = [a['href'] for a in page.find_all('a')]
-            for url in refs:
-                if pattern.match(url):
-                    file_path = os.path.join(self.get_chain_folder(), url.split('?')[0].split('/')[-1])
-                    file_paths.append(file_path)
-                    self.download_url_to_path(url, file_path)
-            next_page_url = page.find('a', text='>')['href']
-            page = bs_parse_url(self.url + next_page_url)
-        return file_paths
+    def list_files(self, d=None):
+        # all the pages of the files table (the site has only the current files)
+        entries = []
+        page = parse_listing_url(self.url, self.get_session())
+        while True:
+            for text, url, size in listing.shufersal_files(page):
+                entry = self.manifest_entry(url.split('?')[0].split('/')[-1], url, size)
+                if entry:
+                    entries.append(entry)
+            next_page_url = listing.shufersal_next_page(page)
+            if next_page_url is None:
+                break
+            page = parse_listing_url(self.url + next_page_url, self.get_session())
+        return entries
 
 
 class PublishedpricesDatabase(ChainScraper):
+    session_max_age = 20 * 60  # the site expires logged in sessions (see post_ajax_dir)
+
     def __init__(self, url='https://url.publishedprices.co.il', chain_name=None, username='', password=''):
         self.base_url = url
         super().__init__(url=url, chain_name=chain_name, username=username, password=password)
 
     def login(self, url, user, password):
-        s = requests.Session()
+        s = create_session()
         login_url = url + '/login'
         res = s.get(login_url, verify=False)
 
@@ -474,9 +918,20 @@ class PublishedpricesDatabase(ChainScraper):
         res = s.post(login_url + '/user', data=payload)
         return s
 
+    def post_ajax_dir(self, body):
+        """
+        post files listing request. if the session has expired (redirected to the login page), log in again and
+        repeat the request
+        """
+        res = self.get_session().post(self.base_url + '/file/ajax_dir', data=body, verify=False)
+        if '/login' in res.url:
+            self.refresh_session()
+            res = self.session.post(self.base_url + '/file/ajax_dir', data=body, verify=False)
+        return res
+
     def get_chain_full_id(self):
         body = 'iDisplayLength=1'  # this number will define the number of file results that we will get
-        res = self.session.post(self.base_url + '/file/ajax_dir', data=body, verify=False)
+        res = self.post_ajax_dir(body)
         for s in res.content.decode('utf8').split('"'):
             m = file_pattern.match(s)  # part of file name
             if m:
@@ -485,53 +940,58 @@ class PublishedpricesDatabase(ChainScraper):
     def download_all_data(self, d=None):
         return self.download_files_by_pattern(full_file_pattern)
 
-    def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
-        folder = self.get_chain_folder()
+    def list_files(self, d=None):
         body = 'iDisplayLength=10000'  # this number will define the number of file results that we will get
-        res = self.session.post(self.base_url + '/file/ajax_dir', data=body, verify=False)
-        pattern = pattern or re.compile(self.id)
-        files = [file_name for file_name in res.content.decode('utf8').split('"') if pattern.match(file_name)]
-        file_paths = []
-        for file_name in files:
-            file_path = os.path.join(folder, file_name)
-            file_paths.append(file_path)
-            if not os.path.exists(file_path):
-                url = self.base_url + '/file/d/' + file_name
-                self.download_url_to_path(url, file_path)
-        return file_paths
+        res = self.post_ajax_dir(body)
+        entries = [self.manifest_entry(file_name, self.base_url + '/file/d/' + file_name)
+                   for file_name in res.content.decode('utf8').split('"')]
+        return [entry for entry in entries if entry]
 
 
 class Nibit(ChainScraper):
     # TODO use the info in http://matrixcatalog.co.il/Content/instructions.txt
     # for better scraping
+    site_manifests = {}  # listing url: ListingManifest of the files of all the chains of the site
+
     def __init__(self, chain_name):
         super().__init__(url='http://matrixcatalog.co.il/NBCompetitionRegulations.aspx', chain_name=chain_name)
 
     def get_chain_full_id(self):
-        page = bs_parse_url(self.url)
-        for tr in page.find('table').find_all('tr'):
-            cells = tr.find_all('td')
-            if cells and cells[1].text == self.name:  # column [1] is the chain name
-                return file_pattern.match(cells[0].text).group('id')
+        return self.get_manifest_full_id()
 
     def download_all_data(self, d=None):
         return self.download_files_by_pattern(full_file_pattern, d) # TODO is date supported for matrixcatalog?
 
-    def download_files_by_pattern(self, pattern=file_pattern, d=None):
-        page = bs_parse_url(self.url)
-        file_paths = []
-        for tr in page.find('table').find_all('tr'):
-            cells = tr.find_all('td')
-            if cells and cells[1].text == self.name:
-                url = 'http://matrixcatalog.co.il/' + cells[7].find('a')['href'].replace('\\', '/')
-                file_name = url.split('/')[-1]
-                if pattern.match(file_name):
-                    file_path = os.path.join(self.get_chain_folder(), file_name)
-                    file_paths.append(file_path)
-                    if not os.path.exists(file_path):
-                        self.download_url_to_path(url, file_path)
+    def get_manifest(self, d=None):
+        """
+        all the chains of the site are listed in the same page, so its listing is fetched (and cached, in the data
+        folder) once for all of them, and each chain reads its own files from it
+        Returns:
+            ListingManifest
+        """
+        try:
+            manifest = Nibit.site_manifests[self.url]
+        except KeyError:
+            cache_path = '.manifest_{}.json'.format(urlparse(self.url).netloc)
+            manifest = Nibit.site_manifests[self.url] = ListingManifest(cache_path, self.list_site_files)
+        return ChainListingManifest(manifest, self.name)
 
-        return file_paths
+    def list_site_files(self):
+        """
+        Returns:
+            list(ManifestEntry): files of all the chains of the site (with chain name)
+        """
+        page = parse_listing_url(self.url, self.get_session())
+        entries = []
+        for chain_name, href in listing.matrix_files(page):
+            url = 'http://matrixcatalog.co.il/' + href.replace('\\', '/')
+            entry = self.manifest_entry(url.split('/')[-1], url)
+            if entry:
+                entries.append(entry._replace(chain=chain_name))
+        return entries
+
+    def list_files(self, d=None):
+        return self.get_manifest(d).get_entries()
 
 
 class Mega(ChainScraper):
@@ -539,31 +999,25 @@ class Mega(ChainScraper):
         super().__init__(url='http://publishprice.mega.co.il/', chain_name='מגה')
 
     def get_chain_full_id(self):
-        today_dir = self.get_today_timestamp()
-        soup = bs_parse_url(self.url + today_dir)
-        for a in soup.find_all('a'):
-            if file_pattern.match(a.text):
-                return file_pattern.match(a.text).group('id')
+        return self.get_manifest_full_id(date.today())
 
     def download_all_data(self, d=None):
         return self.download_files_by_pattern(d=d)
 
-    def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
-        url = self.url + self.get_date_timestamp(d)
-        soup = bs_parse_url(url)
+    def manifest_key(self, d=None):
+        return self.get_date_timestamp(d)
+
+    def get_files_folder(self, d=None):
         folder_path = os.path.join(self.get_chain_folder(), self.get_date_timestamp(d))
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
+        return folder_path
 
-        file_paths = []
-        for a in soup.find_all('a'):
-            if pattern.match(a.text):
-                file_path = os.path.join(folder_path, a.text)
-                file_paths.append(file_path)
-                if not os.path.exists(file_path):
-                    self.download_url_to_path(url + '/' + a['href'], file_path)
-
-        return file_paths
+    def list_files(self, d=None):
+        url = self.url + self.get_date_timestamp(d)
+        page = parse_listing_url(url, self.get_session())
+        entries = [self.manifest_entry(text, url + '/' + href, size) for text, href, size in listing.folder_files(page)]
+        return [entry for entry in entries if entry]
 
 
 class ZolVebegadol(ChainScraper):
@@ -574,31 +1028,25 @@ class ZolVebegadol(ChainScraper):
         return [0]
 
     def get_chain_full_id(self):
-        today_dir = self.get_today_timestamp()
-        soup = bs_parse_url(self.url + today_dir + '/gz/')
-        for a in soup.find_all('a'):
-            if file_pattern.match(a.text):
-                return file_pattern.match(a.text).group('id')
+        return self.get_manifest_full_id(date.today())
 
     def download_all_data(self, d=None):
         return self.download_files_by_pattern()
 
-    def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
-        url = self.url + self.get_date_timestamp(d) + '/gz/'
-        soup = bs_parse_url(url)
+    def manifest_key(self, d=None):
+        return self.get_date_timestamp(d)
+
+    def get_files_folder(self, d=None):
         folder_path = os.path.join(self.get_chain_folder(), self.get_date_timestamp(d))
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
+        return folder_path
 
-        file_paths = []
-        for a in soup.find_all('a'):
-            if pattern.match(a.text):
-                file_path = os.path.join(folder_path, a.text)
-                file_paths.append(file_path)
-                if not os.path.exists(file_path):
-                    self.download_url_to_path(url + '/' + a['href'], file_path)
-
-        return file_paths
+    def list_files(self, d=None):
+        url = self.url + self.get_date_timestamp(d) + '/gz/'
+        page = parse_listing_url(url, self.get_session())
+        entries = [self.manifest_entry(text, url + '/' + href, size) for text, href, size in listing.folder_files(page)]
+        return [entry for entry in entries if entry]
 
 class Bitan(ChainScraper):
     def __init__(self):
@@ -606,23 +1054,13 @@ class Bitan(ChainScraper):
         # TODO note misspelling in the website name - probably should update it dynamiccaly?
 
     def get_chain_full_id(self):
-        page = bs_parse_url(self.url)
-        for a in page.find_all('a'):
-            m = file_pattern.match(a.text)
-            if m:
-                return m.group('id')
+        return self.get_manifest_full_id()
 
-    def download_files_by_pattern(self, pattern=full_file_pattern, d=None):
-        folder = self.get_chain_folder()
-        file_paths = []
-        page = bs_parse_url(self.url)
-        for a in page.find_all('a'):
-            if pattern.match(a.text):
-                file_path = os.path.join(folder, a.text)
-                file_paths.append(file_path)
-                if not os.path.exists(file_path):
-                    self.download_url_to_path(self.url.rstrip('pirce_update') + a['href'], file_path)
-        return file_paths
+    def list_files(self, d=None):
+        page = parse_listing_url(self.url, self.get_session())
+        entries = [self.manifest_entry(text, self.url.rstrip('pirce_update') + href)
+                   for text, href in listing.links(page)]
+        return [entry for entry in entries if entry]
 
 
 class Coop(ChainScraper):
@@ -639,7 +1077,7 @@ class Coop(ChainScraper):
     def get_stores_xml(self, d=None):
         if d is not None: #or date != datetime.date
             logger.warn("Coop doesn't support older dates!")
-        res = self.session.post(self.url + 'branches_to_xml')
+        res = self.get_session().post(self.url + 'branches_to_xml')
         if not res.ok:
             return  # error
         return self.save_res_to_file(res)
@@ -651,7 +1089,7 @@ class Coop(ChainScraper):
             'type': 'gzip',
             'agree': 1,
         }
-        res = self.session.post(self.url + 'get_prices', data=params)
+        res = self.get_session().post(self.url + 'get_prices', data=params)
         return self.save_res_to_file(res)
 
     def get_promos_xml(self, store_id):
@@ -660,7 +1098,7 @@ class Coop(ChainScraper):
             'type': 'gzip',
             'agree': 1,
         }
-        res = self.session.post(self.url + 'get_promo', data=params)
+        res = self.get_session().post(self.url + 'get_promo', data=params)
         return self.save_res_to_file(res)
 
     def save_res_to_file(self, res):
@@ -669,6 +1107,7 @@ class Coop(ChainScraper):
         with open(file_path, 'wb') as f:
             for block in res.iter_content(1024*1000):
                 f.write(block)
+        get_file_catalog(self.get_chain_folder()).add(file_path)
         return file_path
 
 
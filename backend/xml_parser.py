@@ -1,34 +1,293 @@
 # -*- coding: utf-8 -*-
 import re
-import os
 import zipfile
 import gzip
+import time
+import hashlib
+import codecs
+import zlib
 import logging
 from datetime import timedelta, date
+from collections import Counter
 try:
     import lxml.etree as ET
 except ImportError:
     import xml.etree.cElementTree as ET
 
 import web_scraper
+import sql_interface
+from products_batch import ProductsBatch
+from item_registry import get_item_registry
 from sql_interface import Chain, Item, Store, CurrentPrice, PriceHistory, Unit, SessionController, \
-    StoreType, StoreProduct, PriceFunction, PromotionProducts, RestrictionType, Promotion, PriceFunctionType
+    StoreType, StoreProduct, PriceFunction, PromotionProducts, RestrictionType, Promotion, PriceFunctionType, \
+    FileType, IngestedFile, func
+from sqlalchemy import Column, BigInteger, Float, Date, select, exists, literal, and_
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# errors of corrupt (or truncated) files: the file is skipped
+file_errors = (ET.ParseError, IOError, EOFError, zlib.error, zipfile.BadZipfile)
+
 float_re = re.compile(r'\d+\.*\d*')
 
 shufersal_full_id = 7290027600007  # needed for folder name workaround
 mega_full_id = 7290055700007
 zol_full_id = 7290058140886
 
+xml_declaration_encoding_re = re.compile(br'<\?xml[^>]*encoding=["\']([A-Za-z0-9._-]+)["\']')
+xml_head_size = 256  # enough bytes for BOM and xml declaration
+
+records_tags = {}  # (chain id, profile records tags): raw records tag of the chain files (per process)
+
+# chains that call the stores records 'branch' instead of 'store'. TODO: ask government to enforce fixed field names
+branch_chains = ('מחסני להב', 'מחסני השוק', 'ויקטורי')
+
+
+def sniff_xml_encoding(head):
+    """
+    Find the actual encoding of xml file from its first bytes (BOM or xml declaration).
+    some chains declare utf-16 encoding for utf-8 files, so the declaration is used only if the bytes agree with it
+
+    Args:
+        head: first bytes of the file
+
+    Returns:
+        str: encoding name (as known to lxml)
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    # utf-16 without BOM
+    if head.startswith(b'<\x00'):
+        return 'utf-16le'
+    if head.startswith(b'\x00<'):
+        return 'utf-16be'
+    m = xml_declaration_encoding_re.match(head)
+    if m:
+        encoding = m.group(1).decode('ascii')
+        if not encoding.lower().startswith('utf-16'):  # ascii compatible bytes can't be utf-16
+            return encoding
+    return 'utf-8'
+
+
+def text2str(text):
+    """
+    Convert xml element text to string
+
+    Args:
+        text: element text (None for empty element)
+
+    Returns:
+        str
+    """
+    try:
+        return text.strip()
+    except AttributeError:  # no text for the tag
+        return ''
+
+
+def text2float(text):
+    """
+    Convert xml element text to float
+
+    Args:
+        text: element text (None for empty element)
+
+    Returns:
+        float
+    """
+    try:
+        return float(float_re.match(text).group(0))
+    except AttributeError:  # no number in the text
+        return 0
+    except TypeError:  # no text for the tag
+        return 0
+
+
+def text2int(text):
+    """
+    Convert xml element text to int
+
+    Args:
+        text: element text (None for empty element)
+
+    Returns:
+        int
+    """
+    return int(text2float(text))
+
+
+def text2bool(text):
+    """
+    Convert xml element text to bool. 1 is the only TRUE value
+
+    Args:
+        text: element text (None for empty element)
+
+    Returns:
+        bool
+    """
+    return text2int(text) == 1
+
+
+class TagNormalizer(object):
+    """
+    Map raw xml tags to their canonical (lower case) names.
+
+    Chains spell the same tags differently (ItemCode/itemcode/ITEMCODE), so every distinct raw tag is resolved once and
+    cached. Each file should get its own normalizer, the cache stays small since a file has only few distinct tags.
+    """
+    def __init__(self):
+        self.canonical_tags = {}
+
+    def canonical(self, tag):
+        """
+        get the canonical name of a raw tag
+        Args:
+            tag: raw tag (as appears in the file)
+
+        Returns:
+            str: canonical tag
+        """
+        try:
+            return self.canonical_tags[tag]
+        except KeyError:
+            # comments and processing instructions have no str tag
+            canonical_tag = tag.lower() if isinstance(tag, str) else tag
+            self.canonical_tags[tag] = canonical_tag
+            return canonical_tag
+
+    def normalize(self, element):
+        """
+        set the canonical tags to the element and all its sub elements (in place)
+        Args:
+            element: ET.element
+
+        Returns:
+            ET.element: the same element
+        """
+        for sub_element in element.iter():
+            tag = sub_element.tag
+            canonical_tag = self.canonical(tag)
+            if canonical_tag != tag:
+                sub_element.tag = canonical_tag
+        return element
+
+
+class SchemaProfile(object):
+    """
+    Describe the records of a file type: the tag of the records and the fields to extract from each record.
+    """
+    def __init__(self, records_tags, fields):
+        """
+        Args:
+            records_tags: possible (canonical) tags of the records. the actual one is detected once per file
+            fields: dict of canonical field tag: (field name, text converter)
+        """
+        self.records_tags = records_tags
+        self.fields = fields
+
+    def extractor(self):
+        """
+        Returns:
+            RecordExtractor: new extractor for a single file
+        """
+        return RecordExtractor(self)
+
+
+class RecordExtractor(object):
+    """
+    Single pass extraction of all profile fields from a record.
+    The raw tag -> field resolution is cached, so each record costs one iteration over its children.
+    """
+    def __init__(self, profile):
+        self.profile = profile
+        self.tags = TagNormalizer()
+        self.raw_tags_fields = {}
+        self.defaults = dict((name, converter(None)) for name, converter in profile.fields.values())
+
+    def __call__(self, record):
+        """
+        Args:
+            record: ET.element of the record (with raw tags)
+
+        Returns:
+            dict: field name: converted value. missing fields get the converter default
+        """
+        values = self.defaults.copy()
+        for child in record:
+            try:
+                field = self.raw_tags_fields[child.tag]
+            except KeyError:
+                field = self.profile.fields.get(self.tags.canonical(child.tag))
+                self.raw_tags_fields[child.tag] = field
+            if field is not None:
+                name, converter = field
+                values[name] = converter(child.text)
+        return values
+
+
+prices_profile = SchemaProfile(('item', 'product'), {
+    'itemcode': ('code', text2int),
+    'itemtype': ('external', text2bool),  # 1 is global, 0 is internal
+    'itemname': ('name', text2str),
+    'quantity': ('quantity', text2float),
+    'unitqty': ('unit', text2str),
+    'itemprice': ('price', text2float),
+})
+
+stores_fields = {
+    'storeid': ('store_id', text2int),
+    'storename': ('name', text2str),
+    'city': ('city', text2str),
+    'address': ('address', text2str),
+    'storetype': ('type', text2int),
+    'subchainid': ('subchain_id', text2int),
+    'subchainname': ('subchain_name', text2str),
+}
+
 
 class ChainXmlParser(object):
     def __init__(self, db_chain, db=None):
-        self.db = db or SessionController()
+        self._db = db
         self.page_size = 100000
         self.chain = db_chain
+        self.stats = Counter()  # number of parsed/skipped files
+
+    @property
+    def db(self):
+        """
+        DB is connected only on first use, so processes that only parse files don't connect to it.
+        the engine of the process is used if there is one (see sql_interface.init_process_engine)
+        """
+        if self._db is None:
+            if sql_interface.process_engine is not None:
+                self._db = SessionController(engine=sql_interface.process_engine)
+            else:
+                self._db = SessionController()
+        return self._db
+
+    def close(self):
+        """
+        close the DB session of the parser (if it was connected)
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def commit(self):
+        """
+        commit to DB. if the commit fails, the items registry may hold ids of items that were rolled back,
+        so it is reset
+        Returns:
+            bool: True if the commit succeeded
+        """
+        if self.db.commit():
+            return True
+        get_item_registry(self.db).reset()
+        return False
 
     @staticmethod
     def elm2str(element, tag):
@@ -42,11 +301,7 @@ class ChainXmlParser(object):
         Returns:
             str
         """
-        text = element.find(tag).text
-        try:
-            return text.strip()
-        except AttributeError:  # no text for the tag
-            return ''
+        return text2str(element.find(tag).text)
 
     @staticmethod
     def elm2int(element, tag):
@@ -77,13 +332,7 @@ class ChainXmlParser(object):
         Returns:
             float
         """
-        text = element.find(tag).text
-        try:
-            return float(float_re.match(text).group(0))
-        except AttributeError:  # no text for the tag
-            return 0
-        except TypeError:
-            return 0
+        return text2float(element.find(tag).text)
 
     @staticmethod
     def elm2bool(element, tag):
@@ -125,106 +374,156 @@ class ChainXmlParser(object):
         chain = self.chain
         logger.info('Parsing {} stores'.format(chain))
         stores_file = self.get_stores_file()
+        digest = self.file_digest(stores_file)
+        if self.is_unchanged(FileType.stores, None, digest):
+            logger.info('{} stores file is unchanged, skipping it'.format(chain))
+            self.record_ingested_file(FileType.stores, None, date.today(), digest, skipped=True)
+            self.commit()
+            return
         xml = self.get_parsed_file(stores_file)
 
-        # code for handling stupid naming convention. TODO: ask government to enforce fixed field names
-        name = chain.name
-        if name in ('מחסני להב', 'מחסני השוק', 'ויקטורי'):
-            store_elm_text = 'branch'
-        else:
-            store_elm_text = 'store'
-
+        profile = self.get_stores_profile()
+        extract = profile.extractor()
         chain_id = chain.id
         subchains = self.get_subchains_ids(xml)
-        stores = []
-        for store_elm in xml.iter(store_elm_text):
-            store_id = self.elm2int(store_elm, 'storeid')
-            name = self.elm2str(store_elm, 'storename')
-            city = self.elm2str(store_elm, 'city')
-            address = self.elm2str(store_elm, 'address')
-            store_type = StoreType(self.elm2int(store_elm, 'storetype'))
-
+        stores = {}  # store_id: row (unique by store id)
+        for store_elm in xml.iter(*profile.records_tags):
+            fields = extract(store_elm)
             if len(subchains) > 1:  # handling chains with multiple subchains in same file
-                subchain_id = self.elm2int(store_elm, 'subchainid')
-                if subchain_id != chain.subchain_id: continue
-                subchain_name = self.elm2str(store_elm, 'subchainname')
-                chain.name = subchain_name
-            store = Store(store_id=store_id, chain_id=chain_id, name=name, city=city, address=address, type=store_type)
-            stores.append(store)
-
-        # filter out existing stores # TODO update instead of filtering?
-        existing_stores_ids = set(
-            store.store_id for store in self.db.query(Store).filter(Store.chain_id == chain.id).all())
-        new_stores = [store for store in stores if store.store_id not in existing_stores_ids]
+                if fields['subchain_id'] != chain.subchain_id: continue
+                chain.name = fields['subchain_name']
+            stores[fields['store_id']] = (chain_id, fields['store_id'], fields['name'], fields['city'],
+                                          fields['address'], StoreType(fields['type']))
+
+        # new stores are added, and stores with changed details (name, address...) are updated
+        new_stores = self.db.upsert(Store, ('chain_id', 'store_id'),
+                                    ('chain_id', 'store_id', 'name', 'city', 'address', 'type'), list(stores.values()))
         if new_stores:
-            logger.info('adding {} new stores to chain {}\n'.format(len(new_stores), chain))
-            self.db.bulk_insert(new_stores)
-            self.db.commit()
+            logger.info('added {} new stores to chain {}\n'.format(len(new_stores), chain))
+        self.record_ingested_file(FileType.stores, None, date.today(), digest)
+        self.commit()
 
-    def get_products_prices(self, store, prices_xml):
+    def get_products_prices(self, store, prices_file):
         """
-        Parse prices xml and return all items in it in a dictionary of Item: price
+        Parse prices xml and return all items in it as a batch of products and prices
         Args:
             store: db store
-            prices_xml:
+            prices_file: path to the prices file
 
         Returns:
-
+            ProductsBatch
         """
-        item_elm_name = 'item'
-        if not [tag for tag in prices_xml.iter(item_elm_name)]:  # TODO handling sudden change of file format!
-            item_elm_name = 'product'
+        profile = self.get_prices_profile()
+        start = time.time()
+        # the records tag of the chain files is found once, and passed on to the next files (no extra file read)
+        key = (self.chain.id, profile.records_tags)
+        records_tag = records_tags.get(key)
+        products_prices = self.read_products_prices(prices_file, profile, records_tag)
+        if records_tag is not None and not len(products_prices):  # the chain files tags may have changed
+            records_tag = None
+        if records_tag is None:
+            records_tag = records_tags[key] = self.find_records_tag(prices_file, profile.records_tags)
+            products_prices = self.read_products_prices(prices_file, profile, records_tag)
+
+        elapsed = time.time() - start
+        logger.info('Parsed items: {} ({:.0f} records/sec)'.format(
+            len(products_prices), len(products_prices) / elapsed if elapsed else 0))
+        return products_prices
 
-        products_prices = {}
-        for item_elm in prices_xml.iter(item_elm_name):
-            code = self.elm2int(item_elm, 'itemcode')
+    def read_products_prices(self, prices_file, profile, records_tag):
+        """
+        read the products and prices of the records with given (raw) tag
+        Returns:
+            ProductsBatch
+        """
+        extract = profile.extractor()
+        products_prices = ProductsBatch()
+        if records_tag is None:
+            return products_prices
+        for item_elm in self.iter_profile_records(prices_file, profile, records_tag):
+            fields = extract(item_elm)
+            code = fields['code']
             # TODO zolBagadol has no item code for internal items
             # if self.chain.name == 'זול ובגדול':
             #     is_internal = not self.elm2bool(item_elm, 'innerbarcode')  # TODO !!!
             # else:
-            is_external = self.elm2bool(item_elm, 'itemtype')  # 1 is global, 0 is internal
+            is_external = fields['external']
             is_external &= len(
                 str(code)) >= 13  # TODO: double check for internal item value & code because of stupid chains (zol)
-            name = self.elm2str(item_elm, 'itemname')
-            quantity = self.elm2float(item_elm, 'quantity')
+            quantity = fields['quantity']
             if quantity > 10 ** 3:  # TODO some sotres use wrong numbers for some of the products here
                 quantity = 0
-            unit = self.elm2str(item_elm, 'unitqty')
             # TODO add itemstatus?
-            item = StoreProduct(
-                code=code, store_id=store.id, external=is_external, name=name, quantity=quantity,
-                unit=unit
-            )
-            price = self.elm2float(item_elm, 'itemprice')
-            products_prices[item] = price
-
-        logger.info('Parsed items: {}'.format(len(products_prices)))
+            products_prices.add(code, is_external, fields['name'], quantity, fields['unit'], fields['price'])
         return products_prices
 
+    def get_prices_profile(self):
+        """
+        Returns:
+            SchemaProfile: profile of the chain prices files
+        """
+        return prices_profile
+
+    def get_stores_profile(self):
+        """
+        Returns:
+            SchemaProfile: profile of the chain stores file
+        """
+        # code for handling stupid naming convention.
+        if self.chain.name in branch_chains:
+            return SchemaProfile(('branch',), stores_fields)
+        return SchemaProfile(('store',), stores_fields)
+
     @staticmethod
-    def set_products_item_id(db):
+    def link_products_items(db, *conditions):
         """
-        connect store products with items table. for global items only
-        need to be called after db was committed
+        connect global store products that are not connected yet with items table (item with the same code),
+        with a single UPDATE statement. products with codes that are not in items table are left unconnected
+
+        Args:
+            db: SessionController
+            *conditions: conditions on the updated store products (e.g. store, ids range)
+
+        Returns:
+            int: number of connected products
         """
-        # TODO logging
-        # TODO this unction assumes all global items are correctly marked as such in the files
+        # TODO this function assumes all global items are correctly marked as such in the files
         # and that no internal item is marked as global (which is far fetched assumption... :(
-        page_size = 100000
-        products = db.query(StoreProduct).filter(StoreProduct.external == True). \
-            filter(StoreProduct.item_id == None).yield_per(page_size)
-
-        item_codes_ids = dict(db.query(Item.code, Item.id).yield_per(page_size))
-        i = 0
-        for product in products:
-            code = product.code
-            item_id = item_codes_ids[code]
-            product.item_id = item_id
-            i += 1
-            if not i % 10000:
-                print('flushing ', i)
-                db.session.flush()
+        products = StoreProduct.__table__
+        items = Item.__table__
+        # same code for more than one item - first one is used (as in the items registry)
+        item_id = select([func.min(items.c.id)]).where(items.c.code == products.c.code).as_scalar()
+        return db.execute(products.update()
+                          .where(products.c.external == True)
+                          .where(products.c.item_id == None)
+                          .where(and_(*conditions))
+                          .where(item_id != None)
+                          .values(item_id=item_id)).rowcount
+
+    @staticmethod
+    def set_products_item_id(db, first_id=None, last_id=None, chunk_size=100000):
+        """
+        connect all store products with items table. for global items only.
+        the products are updated in chunks of ids range, so different ranges can be updated in parallel
+        (products are connected on ingest, see ingest_store_prices. this is needed only for old DBs)
 
+        Args:
+            db: SessionController
+            first_id: first store product id to update (default is the first in DB)
+            last_id: last store product id to update (default is the last in DB)
+            chunk_size: number of ids in each UPDATE statement
+        """
+        min_id, max_id = db.query(func.min(StoreProduct.id), func.max(StoreProduct.id)).one()
+        first_id = min_id if first_id is None else first_id
+        last_id = max_id if last_id is None else last_id
+        if first_id is None or last_id is None:  # no products
+            return
+        linked = 0
+        for chunk_start in range(first_id, last_id + 1, chunk_size):
+            chunk_end = min(chunk_start + chunk_size - 1, last_id)
+            linked += ChainXmlParser.link_products_items(db, StoreProduct.id >= chunk_start,
+                                                         StoreProduct.id <= chunk_end)
+            logger.info('connected store products to items up to id {} ({})'.format(chunk_end, linked))
         db.commit()
 
     @staticmethod
@@ -266,29 +565,82 @@ class ChainXmlParser(object):
         Args:
             store: DB Store
         """
+        file_date = file_date or date.today()
+        last_file = self.get_last_ingested_file(FileType.prices, store)
+        parsed = self.read_store_prices(store, file_date, last_file.digest if last_file is not None else None)
+        if parsed is None:
+            return
+        digest, products_prices = parsed
+        self.ingest_store_prices(store, file_date, digest, products_prices)
+        self.commit()  # finally - commit everything ot DB
+
+    def read_store_prices(self, store, file_date=None, last_digest=None):
+        """
+        get the prices file of the store and parse it. no DB access is done here,
+        so it can run in processes that only parse files (see ingest_store_prices)
+
+        Args:
+            store: DB Store
+            file_date:
+            last_digest: digest of the last ingested prices file of the store
+
+        Returns:
+            (digest, ProductsBatch): the batch is None if the file content is the same as the last ingested file.
+            None if the file is missing or corrupt
+        """
         # TODO clean up file getting part
         file_date = file_date or date.today()
         logger.info('Parsing store: {} prices ({})'.format(store, file_date))
         try:
-            prices_xml = self.get_prices_file(store, file_date)
+            prices_file = self.get_prices_file(store, file_date)
         except BaseException:
             logger.exception("something went wrong while trying to get prices for {}".format(store))
             return
-        if prices_xml is None:
+        if prices_file is None:
             logger.warn("Missing prices xml for {}!".format(store))
             return
-        # get all products from the file
-        products_prices = self.get_products_prices(store, prices_xml)
+
+        try:
+            # same content as the last parsed file means no changes in prices (or in the store products)
+            digest = self.file_digest(prices_file)
+            if digest is not None and digest == last_digest:
+                return digest, None
+
+            # get all products from the file
+            return digest, self.get_products_prices(store, prices_file)
+        except file_errors:
+            logger.exception("couldn't parse prices file {} of {}, skipping it".format(prices_file, store))
+
+    def ingest_store_prices(self, store, file_date, digest, products_prices):
+        """
+        add the parsed prices of a store to the DB (without committing)
+
+        Args:
+            store: DB Store
+            file_date:
+            digest: prices file digest
+            products_prices (ProductsBatch): parsed products. None if the file is unchanged (see read_store_prices)
+        """
+        if products_prices is None:
+            logger.info('Prices file of store {} ({}) is unchanged, skipping it'.format(store, file_date))
+            # current prices could be left out of date only if the last file was not parsed in its own date
+            last_file = self.get_last_ingested_file(FileType.prices, store)
+            if file_date == date.today() and last_file.file_date != last_file.ingest_date:
+                self.update_current_prices(store)
+            self.record_ingested_file(FileType.prices, store, file_date, digest, skipped=True)
+            return
 
         # 1) add new items to main items table
         self.add_new_items(products_prices)
 
-        # 2) add new products to store_products table
+        # 2) add new products to store_products table, and connect the global products to their items
         self.add_new_store_products(store, products_prices)
+        self.link_products_items(self.db, StoreProduct.store_id == store.id)
 
         self.db.flush()  # need to commit in order to assign ids to Items and StoreProducts #TODO maybe session.flush?
 
         # 3) update price history table
+        self.db.ensure_history_partitions(file_date, file_date)
         self.update_history_table(store, products_prices, file_date)
 
         self.db.flush()  # commit needed for next step
@@ -296,182 +648,257 @@ class ChainXmlParser(object):
         # update current prices table
         if file_date == date.today():
             self.update_current_prices(store)
-        self.db.commit()  # finally - commit everything ot DB
+        self.record_ingested_file(FileType.prices, store, file_date, digest)
 
     def add_new_items(self, products_prices):
         """
-        Add new items (if found such) to items table
+        Add new items (if found such) to items table, and to the items registry.
+        codes that are not in the registry are looked up in the DB first, as other processes may have added them
 
         Args:
-            products_prices:
+            products_prices (ProductsBatch):
 
         Returns:
 
         """
-        existing_items_codes = set(code for code,  # this ',' is there for unpacking the results
-                                   in self.db.query(Item.code).yield_per(self.page_size))
-
-        global_products = set(product for product in products_prices if product.is_external())
-        new_global_items = set(item for item in global_products if item.code not in existing_items_codes)
-        if new_global_items:
-            new_items = [Item.from_store_product(product) for product in new_global_items]  # generate new Items
-            logger.info('adding new global items to items table ({})'.format(len(new_items)))
-            self.db.bulk_insert(new_items)
+        registry = get_item_registry(self.db)
+        codes = products_prices.codes
+        new_rows = [row for row in products_prices.external_rows() if codes[row] not in registry]
+        if new_rows:
+            # items that were added by other processes since the registry was loaded
+            registry.add_from_db(self.db, [codes[row] for row in new_rows])
+            new_rows = [row for row in new_rows if codes[row] not in registry]
+        if new_rows:
+            logger.info('adding new global items to items table ({})'.format(len(new_rows)))
+            self.db.bulk_load(Item, ProductsBatch.item_columns, [products_prices.item_row(row) for row in new_rows])
+            registry.add_from_db(self.db, [codes[row] for row in new_rows])
 
     def add_new_store_products(self, store, products_prices):
         """
-        Add new products to store (if any new products exist)
+        Add new products to store (if any new products exist), and update the products whose details were changed
 
         Args:
             store:
-            products_prices:
+            products_prices (ProductsBatch):
 
         Returns:
+            dict: code: store product id, of the new products
+        """
+        store_id = store.id
+        new_products = self.db.upsert(StoreProduct, ('store_id', 'code'), ProductsBatch.store_product_columns,
+                                      [products_prices.store_product_row(row, store_id)
+                                       for row in range(len(products_prices))])
+        if new_products:
+            logger.info('added new store products to store products table ({})'.format(len(new_products)))
+        return dict((code, product_id) for product_id, store_id, code in new_products)
 
+    def backfill_store_prices(self, store, start_date, end_date=None):
         """
-        exiting_codes = set(code for code,  # this ',' is there for unpacking the results
-                            in self.db.query(StoreProduct.code).filter(
-            StoreProduct.store_id == store.id).yield_per(self.page_size))
+        parse the prices files of a store for a range of dates.
 
-        new_products = set(product for product in products_prices if product.code not in exiting_codes)
-        if new_products:
-            logger.info('adding new store products to store products table ({})'.format(len(new_products)))
-            self.db.bulk_insert(new_products)
+        The result is the same as calling parse_store_prices for each date in order, but the open history entries are
+        kept in memory between the dates, and all history rows are written to the DB once at the end.
+
+        Args:
+            store: DB Store
+            start_date: first date to parse
+            end_date: last date to parse (default is today)
+        """
+        end_date = end_date or date.today()
+        logger.info('Backfilling store: {} prices ({} - {})'.format(store, start_date, end_date))
+
+        products_ids = dict(self.db.query(StoreProduct.code, StoreProduct.id)
+                            .filter(StoreProduct.store_id == store.id).yield_per(self.page_size))
+
+        # open history entries: store product id: [history entry id (None if not in DB yet), start date, price]
+        open_entries = dict(
+            (product_id, [entry_id, start, price]) for entry_id, product_id, start, price in
+            self.db.query(PriceHistory.id, PriceHistory.store_product_id, PriceHistory.start_date, PriceHistory.price)
+            .join(StoreProduct)
+            .filter(StoreProduct.store_id == store.id)
+            .filter(PriceHistory.end_date == None).yield_per(self.page_size))
+        closed_db_entries = []  # end date updates of entries that are already in DB
+        new_entries = []  # entries that were opened and closed during the backfill
+
+        def close_entry(product_id, end):
+            entry_id, start, price = open_entries.pop(product_id)
+            if entry_id is None:
+                new_entries.append((product_id, start, end, price))
+            else:
+                closed_db_entries.append({'id': entry_id, 'end_date': end})
+
+        last_file = self.get_last_ingested_file(FileType.prices, store)
+        last_digest = last_file.digest if last_file is not None else None
+        last_parsed_date = None
+        file_date = start_date
+        while file_date <= end_date:
+            parsed = self.read_store_prices(store, file_date, last_digest)
+            if parsed is not None:
+                last_digest, products_prices = parsed
+                last_parsed_date = file_date
+                if products_prices is None:
+                    logger.info('Prices file of store {} ({}) is unchanged, skipping it'.format(store, file_date))
+                    self.record_ingested_file(FileType.prices, store, file_date, last_digest, skipped=True)
+                    file_date += timedelta(days=1)
+                    continue
+
+                self.add_new_items(products_prices)
+                products_ids.update(self.add_new_store_products(store, products_prices))
+
+                # same flow as update_history_table, on the in memory entries
+                parsed_prices = dict((products_ids[code], products_prices.price(code))
+                                     for code in products_prices.codes)
+                end = file_date - timedelta(days=1)
+                for product_id in list(open_entries):
+                    if product_id not in parsed_prices:  # removed from store
+                        close_entry(product_id, end)
+                    elif abs(float(open_entries[product_id][2]) - parsed_prices[product_id]) > 0.01:  # new price
+                        close_entry(product_id, end)
+                for product_id, price in parsed_prices.items():
+                    if product_id not in open_entries:
+                        open_entries[product_id] = [None, file_date, price]
+                self.record_ingested_file(FileType.prices, store, file_date, last_digest)
+            file_date += timedelta(days=1)
+
+        self.link_products_items(self.db, StoreProduct.store_id == store.id)
+        new_entries.extend((product_id, start, None, price)
+                           for product_id, (entry_id, start, price) in open_entries.items() if entry_id is None)
+        logger.info('Writing history of store {}: {} new entries, {} closed entries'.format(
+            store, len(new_entries), len(closed_db_entries)))
+        self.db.bulk_update(PriceHistory, closed_db_entries)
+        self.db.ensure_history_partitions(start_date, end_date)
+        self.db.bulk_load(PriceHistory, ('store_product_id', 'start_date', 'end_date', 'price'), new_entries)
+        self.db.flush()
+        if last_parsed_date == date.today():
+            self.update_current_prices(store)
+        self.commit()
 
     def update_history_table(self, store, products_prices, file_date):
         """
         Update price history table to include the changes that new parsing had found.
-        assuming files with dates are parsed in order of dates
-        see comments in code for full flow description.
+        assuming files with dates are parsed in order of dates.
+        the parsed prices are loaded to a staging table, and the history is updated with set based statements,
+        so the number of statements doesn't depend on the number of products in the store.
 
         Args:
             store:
-            products_prices:
+            products_prices (ProductsBatch):
+            file_date:
 
         """
         store_id = store.id
-        # there is a need to have StoreProducts with actual IDs (the ones created in the xml parsing stage has their
-        # id set to None until added to DB.
-        # since __hash__ and __eq__ for StoreProduct are defined by (store_id, code), we can do this trick
-        # that will switch the unassigned products with existing ones (that have id)
-        db_products = set(self.db.query(StoreProduct).filter(StoreProduct.store_id == store_id).all())
-        products_prices = dict(
-            [(product, products_prices[product]) for product in db_products if product in products_prices])
-
-        parsed_ids = set(p.id for p in products_prices)
-
-        all_products = set(self.db.query(PriceHistory).join(StoreProduct) \
-                           .filter(StoreProduct.store_id == store_id) \
-                           .filter(PriceHistory.end_date == None).yield_per(self.page_size))
-        # is None test won't work here^
-
-        all_products_ids = set(p.store_product_id for p in all_products)
-
-        # we have 3 different stages here
-
-        # 1) add items that don't have current price (new items, or that were out of store)
-        new_products = [PriceHistory(store_product_id=product.id, price=products_prices[product], start_date=file_date)
-                        for product in products_prices if product.id not in all_products_ids]
-        if new_products:
-            logger.info('Adding {} new items (no current price) to history table'.format(len(new_products)))
-            self.db.bulk_insert(new_products)
-
-        # 2) update end_date for items that were removed from store today
-        # (appear in db as having current price (have end_date == None), and not appearing in today file)
-        removed_from_store = [p for p in all_products if
-                              p.store_product_id not in parsed_ids]  # TODO change to set methods
-        if removed_from_store:
-            logger.info('Updating end_date to yesterday for all items that are out of store ({})'.
-                        format(len(removed_from_store)))
-            for item in removed_from_store:  # TODO bulk_update
-                # update end_date to yesterday # TODO (or for today?)
-                item.end_date = file_date - timedelta(days=1)
-
-        # 3) items that need to update their current price:
-        # all items with end_date == None and also appear in db_products_prices are possible candidates for this.
-
-        #   a) need to find all items that have new prices
-        update_candidate_ids = set(p.store_product_id for p in all_products if p.store_product_id in parsed_ids)
-        ids_prices = dict(
-            (p.store_product_id, p.price) for p in all_products if p.store_product_id in update_candidate_ids
-        )
-        updated_parsed_products = [product for product in products_prices if
-                                   product.id in update_candidate_ids and
-                                   abs(float(ids_prices[product.id]) - products_prices[product]) > 0.01
-                                   # TODO better type safety for this check
-                                   ]
-
-        updated_products_ids = set(p.id for p in updated_parsed_products)
-
-        new_prices = [PriceHistory(store_product_id=product.id, price=products_prices[product], start_date=file_date)
-                      for product in updated_parsed_products]
-
-        if new_prices:
-            logger.info('Inserting new entries for all items with new price ({})'.format(len(new_prices)))
-            self.db.bulk_insert(new_prices)
-
-        # b) need to update old entry to have yesterday(?) as last date for previous price
-        # [assuming code is running every day]
-        history_updated_products = [product for product in all_products if
-                                    product.store_product_id in updated_products_ids]
-        if history_updated_products:
-            logger.info('Updating end_date to yesterday for all items that have new price ({})'.
-                        format(len(history_updated_products)))
-            for item in history_updated_products:  # TODO bulk update
-                item.end_date = file_date - timedelta(days=1)
+        history = PriceHistory.__table__
+        store_products = StoreProduct.__table__
+        with self.db.staging_table('parsed_prices', Column('code', BigInteger), Column('price', Float)) as parsed:
+            self.db.bulk_load(parsed, ('code', 'price'),
+                              [(code, price) for code, price in zip(products_prices.codes, products_prices.prices)])
+
+            # 1) close open entries of products that were removed from store, or have new price
+            # (their end_date is updated to yesterday) # TODO (or for today?)
+            same_price = select([store_products.c.id]) \
+                .select_from(store_products.join(parsed, parsed.c.code == store_products.c.code)) \
+                .where(store_products.c.id == history.c.store_product_id) \
+                .where(func.abs(parsed.c.price - history.c.price) <= 0.01)
+            store_products_ids = select([store_products.c.id]).where(store_products.c.store_id == store_id)
+            closed = self.db.execute(
+                history.update()
+                .where(history.c.end_date == None)
+                .where(history.c.store_product_id.in_(store_products_ids))
+                .where(~exists(same_price))
+                .values(end_date=file_date - timedelta(days=1)))
+            logger.info('Updated end_date to yesterday for {} items that are out of store or have new price'.
+                        format(closed.rowcount))
+
+            # 2) open entries for all parsed products that don't have current price
+            # (new items, items that were out of store, and the items that were closed above)
+            open_entry = select([history.c.id]) \
+                .where(history.c.store_product_id == store_products.c.id) \
+                .where(history.c.end_date == None)
+            opened = self.db.execute(history.insert().from_select(
+                ['store_product_id', 'price', 'start_date'],
+                select([store_products.c.id, parsed.c.price, literal(file_date, Date)])
+                .select_from(parsed.join(store_products, and_(store_products.c.code == parsed.c.code,
+                                                              store_products.c.store_id == store_id)))
+                .where(~exists(open_entry))))
+            logger.info('Inserted {} new entries (new items, or items with new price) to history table'.
+                        format(opened.rowcount))
 
     def update_current_prices(self, store):
         """
-        Update current prices table for this store.
-        Assuming price history table is already updated (and committed)
+        Update current prices table for this store from its open price history entries.
+        Assuming price history table is already updated (flushed).
+        only the rows of products whose current price was changed are written.
 
         Args:
             store:
         """
-        # this is brute force solution, but probably the fastest...
-        old_current_prices = self.db.query(CurrentPrice).join(StoreProduct) \
-            .filter(StoreProduct.store_id == store.id).yield_per(self.page_size)
-        for item in old_current_prices:
-            self.db.delete(item)
-
-        self.db.flush()
-        new_current_prices = self.db.query(PriceHistory).join(StoreProduct) \
-            .filter(StoreProduct.store_id == store.id) \
-            .filter(PriceHistory.end_date == None).yield_per(self.page_size)
-
-        self.db.bulk_insert([
-                                CurrentPrice(store_product_id=p.store_product_id, price=p.price) for p in
-                                new_current_prices
-                                ])
+        current = CurrentPrice.__table__
+        history = PriceHistory.__table__
+        store_products_ids = select([StoreProduct.__table__.c.id]).where(StoreProduct.__table__.c.store_id == store.id)
+        open_entry = select([history.c.price]) \
+            .where(history.c.store_product_id == current.c.store_product_id) \
+            .where(history.c.end_date == None)
+
+        # 1) products that have no open entry (removed from store)
+        deleted = self.db.execute(current.delete()
+                                  .where(current.c.store_product_id.in_(store_products_ids))
+                                  .where(~exists(open_entry)))
+
+        # 2) products with new price
+        updated = self.db.execute(current.update()
+                                  .where(current.c.store_product_id.in_(store_products_ids))
+                                  .where(exists(open_entry.where(history.c.price != current.c.price)))
+                                  .values(price=open_entry.as_scalar()))
+
+        # 3) products that have no current price (new, or returned to store)
+        current_entry = select([current.c.store_product_id]) \
+            .where(current.c.store_product_id == history.c.store_product_id)
+        inserted = self.db.execute(current.insert().from_select(
+            ['store_product_id', 'price'],
+            select([history.c.store_product_id, history.c.price])
+            .where(history.c.store_product_id.in_(store_products_ids))
+            .where(history.c.end_date == None)
+            .where(~exists(current_entry))))
+        logger.info('Current prices of {}: {} removed, {} updated, {} added'.format(
+            store, deleted.rowcount, updated.rowcount, inserted.rowcount))
 
     def parse_store_promos(self, store, file_date=None):
         file_date = file_date or date.today()
         logger.info('Parsing promos for store: {}  ({})'.format(store, file_date))
         try:
-            promos_xml = self.get_promos_file(store, file_date)
+            promos_file = self.get_promos_file(store, file_date)
         except BaseException:
             logger.exception("something went wrong while trying to get promos for {}".format(store))
             return
         # TODO change handling on all lower levels to raise exceptions
-        if promos_xml is None:
+        if promos_file is None:
             logger.warn("Missing promos xml for {}!".format(store))
             return
 
-        promos = self.get_promos_from_file(store, promos_xml)
+        digest = self.file_digest(promos_file)
+        if self.is_unchanged(FileType.promos, store, digest):
+            logger.info('Promos file of store {} ({}) is unchanged, skipping it'.format(store, file_date))
+            self.record_ingested_file(FileType.promos, store, file_date, digest, skipped=True)
+            self.commit()
+            return
+
+        promos = self.get_promos_from_file(store, promos_file)
         # basic same flow as prices:
         # 1) find all old promotions that still continue and update their end date to today
         # 2) add all new promotions
         # 3) check if promotions is renewed after some time????
         for p in promos:
             print(p)
+        self.record_ingested_file(FileType.promos, store, file_date, digest)
+        self.commit()
 
-    def get_promos_from_file(self, store, promos_xml):
+    def get_promos_from_file(self, store, promos_file):
 
         p_elm_name = 'promotion'
 
         store_id = store.id
         promotions = []
-        for p_elm in promos_xml.iter(p_elm_name):
+        for p_elm in self.iter_records(promos_file, p_elm_name):
             internal_promotion_code = self.elm2int(p_elm, 'promotionid')
             description = self.elm2str(p_elm, 'promotiondescription')
 
@@ -530,33 +957,281 @@ class ChainXmlParser(object):
             amount = self.elm2float(p_elm, 'discountedprice')
         return PriceFunction(function_type=func_type, value=amount)
 
+    @staticmethod
+    def file_digest(file_path):
+        """
+        get digest of the content of a file, without decompressing it.
+        compressed files of same xml content can be different only in their headers, which are not hashed:
+        gz - the header (time stamp, original file name...) is skipped, the compressed data and trailer are hashed
+        zip - the local header of the xml member is skipped, its compressed data is hashed
+
+        Args:
+            file_path: path to file
+
+        Returns:
+            str: hex digest, None if the file has no xml to hash (zip without chain file in it)
+        """
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            if ChainXmlParser.is_zip(file_path):
+                info = ChainXmlParser.zip_member(zipfile.ZipFile(f, 'r'))
+                if info is None:
+                    return None
+                ChainXmlParser.skip_zip_local_header(f, info)
+                remaining = info.compress_size
+                while remaining > 0:
+                    block = f.read(min(remaining, 1024 * 1024))
+                    if not block:
+                        raise EOFError('{} is truncated'.format(file_path))
+                    digest.update(block)
+                    remaining -= len(block)
+                return digest.hexdigest()
+            if ChainXmlParser.is_gz(file_path):
+                ChainXmlParser.skip_gz_header(f)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def zip_member(zip_file):
+        """
+        get the chain file (xml) member of a zip
+        Args:
+            zip_file (zipfile.ZipFile):
+
+        Returns:
+            zipfile.ZipInfo: None if there is no member with chain file name
+        """
+        for info in zip_file.infolist():
+            if web_scraper.file_pattern.match(info.filename):
+                return info
+
+    @staticmethod
+    def skip_zip_local_header(f, info):
+        """
+        move zip file object to the start of the compressed data of a member (after its local header, whose name and
+        extra field sizes can be different from the ones in the zip directory)
+        """
+        f.seek(info.header_offset)
+        header = f.read(30)  # signature, versions, flags, method, time, crc, sizes, name and extra field sizes
+        if len(header) < 30 or header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipfile('bad local header of {}'.format(info.filename))
+        f.seek(int.from_bytes(header[26:28], 'little') + int.from_bytes(header[28:30], 'little'), 1)
+
+    @staticmethod
+    def skip_gz_header(f):
+        """
+        move gz file object to the end of its header (the start of the compressed data)
+        """
+        header = f.read(10)  # magic, method, flags, time stamp, extra flags, os
+        if len(header) < 10 or header[:2] != b'\x1f\x8b':  # not gz after all - hash all of it
+            f.seek(0)
+            return
+        flags = header[3]
+        if flags & 4:  # extra field
+            extra_size = int.from_bytes(f.read(2), 'little')
+            f.read(extra_size)
+        for flag in (8, 16):  # zero terminated original file name and comment
+            if flags & flag:
+                while f.read(1) not in (b'\x00', b''):
+                    pass
+        if flags & 2:  # header crc
+            f.read(2)
+
+    def get_last_ingested_file(self, file_type, store):
+        """
+        get the last ingested file of given type
+        Args:
+            file_type (FileType):
+            store: DB Store, None for chain files (stores)
+
+        Returns:
+            IngestedFile: None if no such file was ingested
+        """
+        return self.db.query(IngestedFile) \
+            .filter(IngestedFile.chain_id == self.chain.id) \
+            .filter(IngestedFile.store_id == (store.id if store is not None else None)) \
+            .filter(IngestedFile.file_type == file_type) \
+            .order_by(IngestedFile.id.desc()).first()
+
+    def get_stores_last_digests(self, file_type):
+        """
+        get the digests of the last ingested files of all chain stores (single query)
+        Args:
+            file_type (FileType):
+
+        Returns:
+            dict: store id (DB id): digest
+        """
+        last_ids = self.db.query(func.max(IngestedFile.id)) \
+            .filter(IngestedFile.chain_id == self.chain.id) \
+            .filter(IngestedFile.file_type == file_type) \
+            .group_by(IngestedFile.store_id)
+        return dict(self.db.query(IngestedFile.store_id, IngestedFile.digest).filter(IngestedFile.id.in_(last_ids)))
+
+    def is_unchanged(self, file_type, store, digest):
+        """
+        check if the file digest is the same as the last ingested file of the same type
+        Args:
+            file_type (FileType):
+            store: DB Store, None for chain files (stores)
+            digest: file digest (None is never unchanged)
+
+        Returns:
+            bool
+        """
+        last_file = self.get_last_ingested_file(file_type, store)
+        return digest is not None and last_file is not None and last_file.digest == digest
+
+    def record_ingested_file(self, file_type, store, file_date, digest, skipped=False):
+        """
+        add the file to the ingested files. need to be committed together with the file data
+        Args:
+            file_type (FileType):
+            store: DB Store, None for chain files (stores)
+            file_date:
+            digest: file digest
+            skipped: True if the file was skipped because its content is unchanged
+        """
+        self.stats['skipped_files' if skipped else 'parsed_files'] += 1
+        self.db.add(IngestedFile(chain_id=self.chain.id, store_id=store.id if store is not None else None,
+                                 file_type=file_type, file_date=file_date, digest=digest))
+
     @staticmethod
     def get_parsed_file(file_path):
         """
         get a parsed xml object from a given file path
-        the file can be either compressed gz file or not
+        the file can be either compressed gz/zip file or not.
+        the (decompressed) file is parsed as a stream, without reading or decoding it to memory first
 
         Args:
             file_path: path to file
 
         Returns:
+            ET.element: root element of the xml, with canonical tags (see TagNormalizer)
+        """
+        with ChainXmlParser.open_xml_file(file_path) as f:
+            parser = ET.XMLParser(encoding=ChainXmlParser.get_xml_encoding(f))
+            tree = ET.parse(f, parser).getroot()
+        # canonical tags are lower case, so chains with different tags case can be handled the same way
+        return TagNormalizer().normalize(tree)
 
+    @staticmethod
+    def get_xml_encoding(f):
+        """
+        get the encoding of xml file object, without consuming any of it
+
+        Args:
+            f: binary file object (with peek support)
+
+        Returns:
+            str: encoding name
+        """
+        return sniff_xml_encoding(f.peek(xml_head_size)[:xml_head_size])
+
+    @staticmethod
+    def open_xml_file(file_path):
+        """
+        open the xml in a given file path as binary file object, without reading it to memory
+        the file can be either compressed gz/zip file or not
+
+        Args:
+            file_path: path to file
+
+        Returns:
+            file object. zip member keeps the zip file open until it is closed
+
+        Raises:
+            zipfile.BadZipfile: zip without chain file in it
         """
         if ChainXmlParser.is_gz(file_path):
-            xml = ChainXmlParser.get_xml_from_gz(file_path)
+            return gzip.GzipFile(file_path, mode='r')
         elif ChainXmlParser.is_zip(file_path):
-            f = zipfile.ZipFile(file_path, 'r')
-            for name in f.namelist():
-                if web_scraper.file_pattern.match(name):
-                    xml = f.open(name).read()
-        elif ChainXmlParser.is_xml(file_path):
-            try:
-                with open(file_path, encoding="utf16") as f:
-                    xml = f.read()
-            except UnicodeDecodeError:
-                with open(file_path, encoding="utf8") as f:
-                    xml = f.read()
-        return ChainXmlParser.parse_xml_object(xml)
+            with zipfile.ZipFile(file_path, 'r') as f:
+                info = ChainXmlParser.zip_member(f)
+                if info is None:
+                    raise zipfile.BadZipfile('no chain file in {}'.format(file_path))
+                return f.open(info)
+        return open(file_path, 'rb')
+
+    @staticmethod
+    def iter_records(file_path, *records_tags):
+        """
+        Stream the records (items, products, promotions etc.) of xml file one at a time.
+        Each record is cleared after it is handled, so memory usage doesn't depend on the file size.
+
+        Args:
+            file_path: path to file
+            *records_tags: (lower case) tags of the records elements
+
+        Yields:
+            ET.element: record element, with canonical tags (see TagNormalizer)
+        """
+        tags = TagNormalizer()
+        records_tag = ChainXmlParser.find_records_tag(file_path, records_tags, tags)
+        for element in ChainXmlParser.iter_elements(file_path, records_tag):
+            yield tags.normalize(element)
+
+    @staticmethod
+    def iter_profile_records(file_path, profile, records_tag=None):
+        """
+        Stream the records of the profile, as they appear in the file (with raw tags).
+        use profile.extractor() for getting the records fields
+
+        Args:
+            file_path: path to file
+            profile (SchemaProfile):
+            records_tag: raw tag of the records, if already known (otherwise it is found in the file)
+
+        Yields:
+            ET.element: record element
+        """
+        records_tag = records_tag or ChainXmlParser.find_records_tag(file_path, profile.records_tags)
+        return ChainXmlParser.iter_elements(file_path, records_tag)
+
+    @staticmethod
+    def find_records_tag(file_path, records_tags, tags=None):
+        """
+        Find the raw tag of the records in the file, by reading the file only up to the first record.
+
+        Args:
+            file_path: path to file
+            records_tags: possible canonical tags of the records
+            tags (TagNormalizer): normalizer of the file
+
+        Returns:
+            str: the raw records tag, None if there are no records in the file
+        """
+        tags = tags or TagNormalizer()
+        with ChainXmlParser.open_xml_file(file_path) as f:
+            for event, element in ET.iterparse(f, events=('start',),
+                                             encoding=ChainXmlParser.get_xml_encoding(f)):
+                if tags.canonical(element.tag) in records_tags:
+                    return element.tag
+
+    @staticmethod
+    def iter_elements(file_path, tag):
+        """
+        Stream all elements with given (raw) tag. Each element is cleared after it is handled
+
+        Args:
+            file_path: path to file
+            tag: raw tag of the elements. if None - nothing is yielded
+
+        Yields:
+            ET.element
+        """
+        if tag is None:
+            return
+        with ChainXmlParser.open_xml_file(file_path) as f:
+            for event, element in ET.iterparse(f, events=('end',), tag=tag,
+                                             encoding=ChainXmlParser.get_xml_encoding(f)):
+                yield element
+
+                # free the record, and the references the parent still holds to the already handled records
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
 
     def get_folder(self):  # TODO: remove workaround by fixing web scraper folder names to be taken from DB
         folder = self.chain.name
@@ -575,8 +1250,7 @@ class ChainXmlParser(object):
         Returns:
             str: path to xml file
         """
-        stores_file = self.get_file_path(parent_folder=self.get_folder(),
-                                         pattern=web_scraper.ChainScraper.get_stores_pattern(file_date))
+        stores_file = self.get_file_path(FileType.stores, file_date=file_date)
         if stores_file is None:
             logger.info("couldn't find Stores file for chain: {}, date {}".format(self.chain, file_date))
             logger.info("Trying to download it...")
@@ -585,40 +1259,37 @@ class ChainXmlParser(object):
         return stores_file
 
     def get_prices_file(self, store, file_date=None):
-        pattern = web_scraper.ChainScraper.get_prices_pattern(store.store_id, file_date)
-        prices_file = self.get_file_path(self.get_folder(), pattern)
+        prices_file = self.get_file_path(FileType.prices, store, file_date)
         if prices_file is None:
             logger.info("couldn't find Prices file for store: {}".format(store))
             logger.info("Trying to download it...")
+            pattern = web_scraper.ChainScraper.get_prices_pattern(store.store_id, file_date)
             chain_scraper = web_scraper.db_chain_factory(self.chain)
             prices_file = chain_scraper.get_prices_xml(store.store_id, pattern, file_date)
-        return self.get_parsed_file(prices_file)
+        return prices_file
 
     def get_promos_file(self, store, file_date=None):
-        promos_file = self.get_file_path(parent_folder=self.get_folder(),
-                                         pattern=web_scraper.ChainScraper.get_promos_pattern(store.store_id, file_date))
+        promos_file = self.get_file_path(FileType.promos, store, file_date)
         if promos_file is None:
             logger.info("couldn't find Promos file for chain: {}, date {}".format(self.chain, file_date))
             logger.info("Trying to download it...")
             chain_scraper = web_scraper.db_chain_factory(self.chain)
             promos_file = chain_scraper.get_promos_xml(store.store_id)
-        return self.get_parsed_file(promos_file)
+        return promos_file
 
-    @staticmethod
-    def get_file_path(parent_folder, pattern):
+    def get_file_path(self, file_type, store=None, file_date=None):
         """
-        find file path
+        find the newest downloaded file of the chain
         Args:
-            parent_folder:
-            pattern (re.pattern):
+            file_type (FileType):
+            store: DB Store (not needed for stores file)
+            file_date: date of the file. if None - the newest file
 
         Returns:
-
+            str: path to the file, None if it wasn't downloaded
         """
-        for dirpath, dirnames, filenames in os.walk(parent_folder):
-            for f in filenames:
-                if pattern.match(f):
-                    return os.path.join(dirpath, f)
+        catalog = web_scraper.get_file_catalog(self.get_folder())
+        return catalog.get(file_type, self.chain.full_id, store.store_id if store is not None else None, file_date)
 
     @staticmethod
     def is_gz(file_path):
@@ -646,22 +1317,6 @@ class ChainXmlParser(object):
         """
         return file_path.lower().split('.')[-1] == ext
 
-    @staticmethod
-    def get_xml_from_gz(file_path):
-        """
-        Get xml file (as str) from gz file
-
-        Args:
-            file_path: path to the xml.gz file
-
-        Returns:
-            str: the xml file
-        """
-        decompressed = gzip.GzipFile(file_path, mode='r')
-        decompressed.seek(0)
-        xml_file = decompressed.read()
-        return xml_file
-
     @staticmethod
     def parse_xml_object(xmlobj):
         """
@@ -674,10 +1329,8 @@ class ChainXmlParser(object):
             ElementTree: parsed xml object
         """
         tree = ET.fromstring(xmlobj)
-        # we can convert the xml to lower case, since the intresting data is in hebrew anyway
-        t = ET.tostring(tree)
-        t = t.lower()
-        return ET.fromstring(t)
+        # canonical tags are lower case, so chains with different tags case can be handled the same way
+        return TagNormalizer().normalize(tree)
 
 
 def main():
@@ -696,9 +1349,7 @@ def main():
     chain = db.query(Chain).filter(Chain.id == store.chain_id).one()
     parser = ChainXmlParser(chain, db)
     # f = parser.get_prices_file(store, d)
-    for i in reversed(range(200)):
-        d = date.today() - timedelta(days=i)
-        parser.parse_store_prices(store, d)
+    parser.backfill_store_prices(store, date.today() - timedelta(days=199))
     # prices = parser.get_products_prices(store, f)
     # print(prices)
     # parser.get_products_prices()